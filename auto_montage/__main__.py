@@ -1,10 +1,61 @@
-from . import gui
+import argparse
+import os
+import sys
+from time import time
 
 
-def main():
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='auto_montage',
+        description='Automatic AOSLO montaging. Without a command the GUI is opened.')
+    commands = parser.add_subparsers(dest='command')
+
+    batch = commands.add_parser(
+        'batch', help='montage every subject of a manifest without the GUI')
+    batch.add_argument('manifest', help='yaml file listing the subjects, see auto_montage.batch')
+    batch.add_argument('--jobs', type=int, default=1,
+                       help='subjects montaged at once, each in its own process')
+    batch.add_argument('--workers', type=int, default=None,
+                       help='threads used by each subject, by default the cores shared between jobs')
+    batch.add_argument('--summary', default=None,
+                       help='csv of the time taken by each subject, by default next to the manifest')
+    return parser.parse_args(argv)
+
+
+def run_batch(args):
+    from . import batch
+
+    subjects = batch.load_manifest(args.manifest)
+    workers = args.workers
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // max(1, args.jobs))
+    for subject in subjects:
+        subject.setdefault('workers', workers)
+
+    summary = args.summary
+    if summary is None:
+        summary = os.path.splitext(args.manifest)[0] + '_summary.csv'
+
+    start = time()
+    results = batch.run_batch(subjects, args.jobs)
+    batch.write_summary(results, summary)
+    failed = [name for name, code, _ in results if code != batch.SUCCESS]
+    print('{} of {} subjects montaged in {:.1f}s, summary in {}'.format(
+        len(results) - len(failed), len(results), time() - start, summary))
+    return batch.FAILURE if failed else batch.SUCCESS
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'batch':
+        return run_batch(args)
+
+    # only needs a display when actually used
+    from . import gui
     g = gui.GUI()
     g.root.mainloop()
+    return 0
 
 
 if __name__ == '__main__':
-   main()
\ No newline at end of file
+    sys.exit(main())
@@ -2,6 +2,9 @@ from . import transformation_finder
 from . import montage_builder
 from . import input_pipeline
 from . import script_maker
+from . import multi_modal_image
+from . import session
+from . import instrumentation
 
 import yaml
 
@@ -10,14 +13,76 @@ from time import time
 import sys
 
 
-def main(directory, nominal, eye, naming, photoshop_directory, q, e):
+# what the quick look previews show
+PREVIEW_MODALITY = 'confocal'
+PREVIEW_SCALE = 0.125
 
+
+class NoProgress:
+    """stands in for the progress queue of the gui when there is none"""
+
+    def put(self, item):
+        pass
+
+
+def main(directory, nominal, eye, naming, photoshop_directory, q=None, e=None,
+         workers=None, pixel_budget=None, registration='orb', render_directory=None,
+         preview=False, session_directory=None, trace=None, profile=False, solver='chain'):
+    """
+        q: queue progress is put on as (matched, total, fov index, fov)
+        e: event set when finished
+        workers: threads used for features and registration
+        pixel_budget: bytes of image pixels kept in memory, images are
+                      loaded lazily and reloaded if dropped
+        registration: 'orb', 'phase' or 'orb+phase', see TransformationFinder
+        render_directory: if given every montage is also written there as
+                          tiled, pyramidal BigTIFFs, one per modality,
+                          which can be viewed without photoshop
+        preview: write a 1/8 scale png of every montage next to the
+                 photoshop script, to check the registration quickly
+        session_directory: if given the registrations of each fov are
+                           kept there, so an interrupted run resumes and
+                           a run with movies added only registers those
+        trace: if given the time and peak memory of each stage and
+               counts of what was done are written there as JSON, see
+               instrumentation
+        profile: with trace, also profile the run with cProfile, saved
+                 next to the trace as .prof
+        solver: 'chain' or 'lsq', how images are placed in their
+                montage, see MontageBuilder
+    """
+    if q is None:
+        q = NoProgress()
+    # the pixel cache is shared, so the budget is put back afterwards
+    # rather than carrying over to the next subject of a batch
+    pixel_cache = multi_modal_image.MultiModalImage.pixel_cache
+    max_bytes = pixel_cache.max_bytes
+    if pixel_budget is not None:
+        pixel_cache.max_bytes = pixel_budget
+
+    recorder = instrumentation.start(profile) if trace is not None else None
+    try:
+        montage_fovs(directory, nominal, eye, naming, photoshop_directory, q, workers,
+                     registration, render_directory, preview, session_directory, solver)
+    finally:
+        pixel_cache.max_bytes = max_bytes
+        if recorder is not None:
+            instrumentation.stop()
+            recorder.save(trace)
+    if e is not None:
+        e.set()
+
+
+def montage_fovs(directory, nominal, eye, naming, photoshop_directory, q, workers,
+                 registration, render_directory, preview, session_directory, solver):
+    """montage every fov in directory, see main"""
     print(directory)
     alg_start = time()
     # gets all our files matched with different modalities
     print('Getting all files ...')
-    m = input_pipeline.InputPipeline(directory, nominal, naming, eye)
-    mmList = m.as_multi_modal_objects()
+    with instrumentation.span('input_pipeline'):
+        m = input_pipeline.InputPipeline(directory, nominal, naming, eye)
+        mmList = m.as_multi_modal_objects(lazy=True)
 
     # calculates all keypoints and descriptors
     # then constructs a global registration out
@@ -25,11 +90,18 @@ def main(directory, nominal, eye, naming, photoshop_directory, q, e):
     for i, fov in enumerate(mmList):
         s = time()
         print('Computing keypoints and descriptors for {} fov...'.format(fov))
-        tf = transformation_finder.TransformationFinder(mmList[fov])
-        tf.compute_kps_desc()
+        with instrumentation.span('features', fov=fov, movies=len(mmList[fov])):
+            tf = transformation_finder.TransformationFinder(mmList[fov], registration)
+            previews = [(PREVIEW_MODALITY, PREVIEW_SCALE)] if preview else []
+            tf.compute_kps_desc(workers, previews=previews)
 
         print('Building registrations for {} fov...'.format(fov))
-        tf.compute_pairwise_registrations(q, i, fov)
+        fov_session = None
+        if session_directory is not None:
+            fov_session = session.Session(
+                os.path.join(session_directory, 'session_{}_fov.npz'.format(fov)))
+        with instrumentation.span('registration', fov=fov):
+            tf.compute_pairwise_registrations(q, i, fov, workers, fov_session)
 
         print('Finished {} fov!'.format(fov))
         print('took {}'.format(time() - s))
@@ -37,13 +109,28 @@ def main(directory, nominal, eye, naming, photoshop_directory, q, e):
         # list of lists. The top layer is disjoint
         # montages, followed by the transformations
         # and file names neededd
-        mb = montage_builder.MontageBuilder(tf, evaluate=False)
-        disjoint_montages = mb.construct_all_montages()
+        with instrumentation.span('montage', fov=fov):
+            mb = montage_builder.MontageBuilder(tf, evaluate=False, solver=solver)
+            disjoint_montages = mb.construct_all_montages()
 
         print('Creating photoshop script ...')
-        transformations = [x[0] for x in disjoint_montages]
-        name = 'create_recent_montage_' + str(fov) + '_fov'
-        script_maker.write_photoshop_script(transformations, photoshop_directory, name=name)
-    e.set()
+        with instrumentation.span('photoshop_script', fov=fov):
+            transformations = [x[0] for x in disjoint_montages]
+            name = 'create_recent_montage_' + str(fov) + '_fov'
+            script_maker.write_photoshop_script(transformations, photoshop_directory, name=name)
+
+        if preview:
+            print('Writing previews for {} fov...'.format(fov))
+            with instrumentation.span('preview', fov=fov):
+                indices = [x[1] for x in disjoint_montages]
+                mb.save_previews(
+                    indices, photoshop_directory, 'preview_{}_fov'.format(fov),
+                    PREVIEW_SCALE, PREVIEW_MODALITY, workers)
+
+        if render_directory is not None:
+            print('Rendering montages for {} fov...'.format(fov))
+            with instrumentation.span('render', fov=fov):
+                indices = [x[1] for x in disjoint_montages]
+                mb.save_pyramids(indices, os.path.join(render_directory, '{}_fov'.format(fov)), workers)
     print('Total time taken {}'.format(time() - alg_start))
     # todo clean up temp
@@ -0,0 +1,145 @@
+from . import auto_montage
+
+import yaml
+
+import contextlib
+import csv
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+
+
+# every subject needs these, from its entry or the defaults
+REQUIRED = ('directory', 'nominal', 'eye', 'naming', 'output')
+
+# passed on to auto_montage.main when given
+OPTIONAL = ('workers', 'pixel_budget', 'registration', 'preview', 'solver')
+
+SUCCESS = 0
+FAILURE = 1
+
+LOG_NAME = 'auto_montage.log'
+
+
+def load_manifest(fname):
+    """
+        read a yaml manifest of subjects, as
+
+            defaults:
+              eye: OD
+              naming: {confocal: confocal, split: split_det, avg: avg}
+            subjects:
+              - name: subject_1
+                directory: /data/subject_1
+                nominal: /data/subject_1/nominal.xlsx
+                output: /results/subject_1
+              - ...
+
+        every subject needs directory, nominal, eye, naming and output,
+        from its entry or the defaults. render, session and trace are
+        optional booleans, writing pyramidal BigTIFFs, keeping a
+        resumable session and writing a trace of the time and memory
+        of each stage in the output directory. Returns a list of dicts
+    """
+    with open(fname) as f:
+        manifest = yaml.safe_load(f) or {}
+    defaults = manifest.get('defaults') or {}
+    subjects = []
+    for k, entry in enumerate(manifest.get('subjects') or []):
+        subject = dict(defaults)
+        subject.update(entry)
+        missing = [key for key in REQUIRED if key not in subject]
+        if missing:
+            raise ValueError('Subject {} of {} has no {}'.format(k, fname, ', '.join(missing)))
+        subject.setdefault('name', os.path.basename(os.path.normpath(subject['directory'])))
+        subjects.append(subject)
+    if not subjects:
+        raise ValueError('No subjects in {}'.format(fname))
+    names = [subject['name'] for subject in subjects]
+    if len(set(names)) != len(names):
+        raise ValueError('Subject names in {} are not unique'.format(fname))
+    return subjects
+
+
+def run_subject(subject):
+    """
+        montage one subject, with everything it prints going to a log in
+        its output directory. Returns (name, exit code, seconds)
+    """
+    start = time()
+    output = subject['output']
+    os.makedirs(output, exist_ok=True)
+    kwargs = {key: subject[key] for key in OPTIONAL if key in subject}
+    if subject.get('render'):
+        kwargs['render_directory'] = os.path.join(output, 'render')
+    if subject.get('session'):
+        kwargs['session_directory'] = os.path.join(output, 'session')
+    if subject.get('trace'):
+        kwargs['trace'] = os.path.join(output, 'trace.json')
+
+    code = SUCCESS
+    with open(os.path.join(output, LOG_NAME), 'w') as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            try:
+                auto_montage.main(
+                    subject['directory'],
+                    subject['nominal'],
+                    subject['eye'],
+                    subject['naming'],
+                    output,
+                    **kwargs)
+            except Exception:
+                traceback.print_exc()
+                code = FAILURE
+    return subject['name'], code, time() - start
+
+
+def run_batch(subjects, jobs=1):
+    """
+        montage every subject, jobs at a time in separate processes.
+        Returns a list of (name, exit code, seconds) in manifest order
+    """
+    results = dict()
+    if jobs < 2:
+        for subject in subjects:
+            results[subject['name']] = run_subject(subject)
+            report(results[subject['name']], len(results), len(subjects))
+        return [results[subject['name']] for subject in subjects]
+
+    # spawn, as forking a process using OpenCV threads can deadlock
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        futures = {pool.submit(run_subject, subject): subject for subject in subjects}
+        for future in as_completed(futures):
+            name = futures[future]['name']
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                # the worker died, so nothing was logged
+                print('{} failed: {}'.format(name, error))
+                results[name] = (name, FAILURE, float('nan'))
+            report(results[name], len(results), len(subjects))
+    return [results[subject['name']] for subject in subjects]
+
+
+def report(result, done, total):
+    name, code, seconds = result
+    status = 'done' if code == SUCCESS else 'FAILED'
+    print('[{}/{}] {} {} in {:.1f}s'.format(done, total, name, status, seconds))
+
+
+def write_summary(results, fname):
+    """print a table of each subject and write it to fname as csv"""
+    width = max([len(name) for name, _, _ in results] + [len('subject')])
+    print('{}  {:>6}  {:>10}'.format('subject'.ljust(width), 'status', 'seconds'))
+    for name, code, seconds in results:
+        status = 'ok' if code == SUCCESS else 'failed'
+        print('{}  {:>6}  {:>10.1f}'.format(name.ljust(width), status, seconds))
+
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['subject', 'exit_code', 'seconds'])
+        for name, code, seconds in results:
+            writer.writerow([name, code, '{:.3f}'.format(seconds)])
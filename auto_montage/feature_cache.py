@@ -0,0 +1,144 @@
+import numpy as np
+import cv2
+
+import hashlib
+import json
+import os
+import threading
+import zipfile
+
+
+def default_directory():
+    """AUTO_MONTAGE_CACHE if set, otherwise ~/.cache/auto_montage/features"""
+    directory = os.environ.get('AUTO_MONTAGE_CACHE')
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'auto_montage', 'features')
+    return directory
+
+
+def file_digest(fname, chunk_size=1 << 20):
+    """sha1 of the file contents, so renamed or touched files still hit"""
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class FeatureCache:
+    """
+        On disk store of keypoints and descriptors, one .npz per
+        (image, modality). Keypoints are kept as float32 [n, 2] arrays
+        of their coordinates, as lists of cv2.KeyPoint do not serialise
+        and nothing else about them is used.
+
+        Entries are keyed by the image contents, the modality, the
+        resize factor the keypoints are scaled by and the ORB settings.
+        When the store grows past max_bytes the least recently used
+        entries are deleted.
+    """
+    VERSION = 3
+    EXTENSION = '.npz'
+
+    def __init__(self, directory=None, max_bytes=2 * 1024 ** 3):
+        self.directory = default_directory() if directory is None else directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def key(self, digest, modality, resize, orb_params):
+        description = json.dumps({
+            'version': FeatureCache.VERSION,
+            'opencv': cv2.__version__,
+            'digest': digest,
+            'modality': modality,
+            'resize': resize,
+            'orb': orb_params,
+        }, sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + FeatureCache.EXTENSION)
+
+    def get(self, key):
+        """returns (keypoint_array, descriptors) or None on a miss"""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                kps = data['kps']
+                desc = data['desc'] if data['has_desc'] else None
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return kps, desc
+
+    def put(self, key, kps, desc):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+        has_desc = desc is not None
+        if not has_desc:
+            desc = np.zeros([0, 32], dtype=np.uint8)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, kps=kps, desc=desc, has_desc=has_desc)
+
+        with self._lock:
+            # an entry being overwritten no longer counts
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += os.path.getsize(path) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """(path, bytes, last_used) of every entry"""
+        entries = []
+        try:
+            scanner = os.scandir(self.directory)
+        except OSError:
+            return entries
+        with scanner:
+            for entry in scanner:
+                if not entry.name.endswith(FeatureCache.EXTENSION):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """delete least recently used entries until under max_bytes"""
+        entries = self._entries()
+        entries.sort(key=lambda x: x[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
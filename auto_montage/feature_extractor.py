@@ -0,0 +1,143 @@
+from . import features
+from . import utils
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+import os
+
+
+def _orb_worker(image):
+    """
+        runs in a worker process, cv2.KeyPoint cant be pickled
+        so the keypoints are sent back as an array
+    """
+    kps, desc = features.compute_kps_desc(image)
+    return features.keypoint_coordinates(kps), desc
+
+
+class FeatureExtractor:
+    """
+        Fills the keypoints and descriptors of a list of MultiModalImage
+        objects. Every (image, modality) pair is a separate task, run on
+        a pool of threads or processes. ORB is deterministic so the
+        results are exactly those of calling calculate_orb on each image.
+
+        Images are streamed through in order. Reader threads look each
+        one up in the feature cache and read the pixels of what is not
+        there, a few images ahead of those being worked on, so reading
+        from disk or a network share overlaps feature extraction. The
+        pixels of lazy images are released once all their modalities
+        are done, keeping only the features, and any previews asked for.
+
+        At most in_flight tasks are submitted at any one time, so with
+        the process backend only a bounded number of image copies are
+        ever waiting in, or being worked on by, the pool.
+    """
+    BACKENDS = ('serial', 'thread', 'process')
+
+    def __init__(self, workers=None, backend='thread', readers=2, prefetch=None, previews=()):
+        """
+            workers: size of the pool, defaults to the number of cores
+            backend: 'thread', 'process' or 'serial'. OpenCV releases
+                     the GIL in detectAndCompute so threads scale well
+                     and avoid copying the images
+            readers: threads reading images ahead
+            prefetch: images read ahead of the one whose tasks are being
+                      submitted, held in MultiModalImage.pixel_cache
+            previews: (modality, scale) of previews to make of each
+                      image before its pixels are released, so showing
+                      the montage does not read every image again
+        """
+        if backend not in FeatureExtractor.BACKENDS:
+            raise ValueError('No backend named {}'.format(backend))
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.backend = backend if self.workers > 1 else 'serial'
+        self.in_flight = 2 * self.workers
+        self.readers = readers
+        self.prefetch = 2 * max(self.workers, readers) if prefetch is None else prefetch
+        self.previews = list(previews)
+
+    def _read(self, mm):
+        """
+            on a reader thread, set what features are in the cache and
+            read the pixels if they are needed. Returns the modalities
+            still to compute
+        """
+        uncached = [modality for modality in mm.keypoints.keys() if not mm.load_cached_features(modality)]
+        if uncached or self.previews:
+            mm.load_pixels()
+        return uncached
+
+    def _stream(self, mm_list, remaining):
+        """
+            (image, modality) of each task still to compute, in order,
+            while the next self.prefetch images are read
+        """
+        with ThreadPoolExecutor(max_workers=self.readers) as readers:
+            read = utils.bounded_map(readers, self._read, mm_list, self.prefetch)
+            for mm, uncached in zip(mm_list, read):
+                yield from self._tasks(mm, uncached, remaining)
+
+    def _tasks(self, mm, uncached, remaining):
+        for modality in mm.keypoints.keys():
+            if modality not in uncached:
+                self._done(remaining, mm)
+        for modality in uncached:
+            yield mm, modality
+
+    def _bounded(self, pool, submit, tasks):
+        """
+            submit tasks keeping at most self.in_flight pending,
+            yields (task, result) in the order they finish
+        """
+        pending = dict()
+        for task in tasks:
+            if len(pending) >= self.in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[submit(pool, *task)] = task
+
+        done, _ = wait(pending)
+        for future in done:
+            yield pending.pop(future), future.result()
+
+    def _submit_thread(self, pool, mm, modality):
+        return pool.submit(mm.compute_modality_orb, modality)
+
+    def _submit_process(self, pool, mm, modality):
+        return pool.submit(_orb_worker, mm.get_modality(modality))
+
+    def _done(self, remaining, mm):
+        remaining[mm] -= 1
+        if remaining[mm] == 0 and mm.lazy:
+            for modality, scale in self.previews:
+                mm.get_preview(modality, scale)
+            mm.release_pixels()
+
+    def run(self, mm_list):
+        """compute and set keypoints and descriptors of every image and modality"""
+        remaining = {mm: len(mm.keypoints) for mm in mm_list}
+        tasks = self._stream(mm_list, remaining)
+
+        if self.backend == 'serial':
+            for mm, modality in tasks:
+                mm.compute_modality_orb(modality)
+                self._done(remaining, mm)
+            return
+
+        if self.backend == 'thread':
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+            submit = self._submit_thread
+        else:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+            submit = self._submit_process
+
+        with pool:
+            for (mm, modality), result in self._bounded(pool, submit, tasks):
+                # threads have already set the features
+                if self.backend == 'process':
+                    kps, desc = result
+                    mm.set_features(modality, mm.to_montage_frame(kps), desc)
+                    mm.cache_features(modality)
+                self._done(remaining, mm)
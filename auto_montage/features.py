@@ -1,66 +1,192 @@
+from . import instrumentation
+
 import cv2
 import numpy as np
+import math
+
+
+# settings passed to cv2.ORB_create, also part of the feature cache key
+ORB_PARAMS = dict(
+    nfeatures=5000,
+)
 
 
 def compute_kps_desc(image):
-    orb = cv2.ORB_create(
-        nfeatures=5000,
-    )
+    orb = cv2.ORB_create(**ORB_PARAMS)
     kp, des = orb.detectAndCompute(image, None)
     return kp, des
 
-def match_desc(desc1, desc2, key):
-    """return the matches which pass the ratio test"""
+def keypoint_coordinates(kps):
+    """float32 array [n, 2] of the (x, y) of each cv2.KeyPoint"""
+    if len(kps) == 0:
+        return np.zeros([0, 2], dtype=np.float32)
+    return cv2.KeyPoint_convert(kps).reshape(-1, 2)
 
-    # sometimes there are noe descriptors
-    if desc1 is None or desc2 is None:
-        return [], key
 
-    FLANN_INDEX_LSH = 6
-    index_params = dict(algorithm=FLANN_INDEX_LSH,
+# parameters of the FLANN LSH index used for matching binary ORB descriptors
+FLANN_INDEX_LSH = 6
+LSH_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_LSH,
                         table_number=6,  # 12
                         key_size=12,  # 20
                         multi_probe_level=1)  # 2
+# cvflann::FLANN_DIST_HAMMING, not exposed by the python bindings
+FLANN_DIST_HAMMING = 9
+
+NO_MATCHES = (np.zeros([0], dtype=np.int32), np.zeros([0], dtype=np.int32))
+
+
+def build_index(desc, seed=0):
+    """
+        build an LSH index over desc which can be queried with
+        match_index any number of times, from any thread
+        seed: LSH picks its hash bits with OpenCV's (thread local) RNG,
+              seeding it makes the matches repeatable whatever was
+              matched before
+    """
+    # sometimes there are noe descriptors, and
+    # the ratio test needs two neighbours
+    if desc is None or desc.shape[0] < 2:
+        return None
+
+    cv2.setRNGSeed(seed)
+    return cv2.flann_Index(desc, LSH_INDEX_PARAMS, FLANN_DIST_HAMMING)
+
+
+def knn_search(desc1, index, k=2):
+    """
+        (indices, distances) int32 arrays [n, k] of the k nearest
+        neighbours of each descriptor, indices are -1 where LSH
+        found fewer than k
+    """
     search_params = dict()  # or pass empty dictionary
+    return index.knnSearch(desc1, k, params=search_params)
+
 
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    matches = flann.knnMatch(desc1, desc2, k=2)
+def ratio_test(indices, distances, ratio=0.9):
+    """
+        keep the best neighbour when it is clearly closer than the
+        second best, returns int32 arrays of query and train indices
+    """
+    found = (indices[:, 0] >= 0) & (indices[:, 1] >= 0)
+    good = found & (distances[:, 0] < ratio * distances[:, 1])
+    query_idx = np.flatnonzero(good).astype(np.int32)
+    train_idx = indices[good, 0].astype(np.int32)
+    return query_idx, train_idx
 
-    good_matches = []
 
-    for best_two in matches:
-        if len(best_two) > 1:
-            m, n = best_two
-            if m.distance < 0.9 * n.distance:
-                good_matches.append(m)
+def match_index(desc1, index, key):
+    """
+        return the matches of desc1 against a built index which pass
+        the ratio test, as int32 arrays of query and train indices
+    """
 
-    return good_matches, key
+    # sometimes there are noe descriptors
+    if desc1 is None or index is None:
+        return NO_MATCHES, key
+
+    indices, distances = knn_search(desc1, index)
+    return ratio_test(indices, distances), key
 
 
-def ransac(src, dst, iterations=1000, threshold=10.0):
-    """ransac written in python as nothing in opencv for just translations"""
-    iterations = iterations if iterations < src.shape[0] else src.shape[0]
+def match_desc(desc1, desc2, key, seed=0):
+    """return the matches which pass the ratio test"""
+    return match_index(desc1, build_index(desc2, seed), key)
+
+
+def ransac(src, dst, iterations=1000, threshold=10.0, rng=None,
+           confidence=0.999, max_bytes=8 * 1024 ** 2):
+    """
+        ransac written in python as nothing in opencv for just translations
+        rng: np.random.RandomState used to pick hypotheses, seeding it
+             makes the result independent of the order pairs are run in
+        confidence: stop once this sure that a hypothesis made from an
+                    inlier has been tried, given the best inlier ratio
+                    so far. As a single match defines a translation only
+                    a few hypotheses are needed when most matches agree.
+                    The best is then refined to the consensus of its
+                    inliers, so the count does not depend on when it stops
+        max_bytes: hypotheses are scored in chunks whose error arrays
+                   fit in this, rather than all at once
+    """
+    rng = np.random if rng is None else rng
+    num_matches = src.shape[0]
+    if num_matches == 0:
+        return 0, np.zeros([2], dtype=np.float32)
+    iterations = iterations if iterations < num_matches else num_matches
 
     # potential transformations given by some row
-    rows = np.arange(src.shape[0])
-    np.random.shuffle(rows)
+    rows = np.arange(num_matches)
+    rng.shuffle(rows)
     rows = rows[:iterations]
 
     # all potential translations
     translations = dst[rows, :] - src[rows, :]
 
     # src = matched_points x dimensions
-    # after_tile = num_translations x matched x dimensions
     # translations = num_translations x dimension
-    # y = np.tile(src, (iterations, 1, 1)) + translations[:, None, :]
-    y = src[None, :, :] + translations[:, None, :]
-
-    # y = trans x matched x dim
-    error = (y - dst[None, :, :])
-    error *= error
-    l2 = np.sum(error, axis=2)
-
-    num_inliers = np.sum(l2 < threshold, axis=1)
-    best = np.argmax(num_inliers)
-
-    return num_inliers[best], translations[best]
+    chunk = max_bytes // (num_matches * src.shape[1] * src.itemsize)
+    chunk = int(min(max(chunk, 1), iterations))
+
+    best_inliers = -1
+    best_translation = None
+    tried = 0
+    while tried < iterations:
+        chunk_translations = translations[tried:tried + chunk]
+        tried += chunk_translations.shape[0]
+
+        # y = trans x matched x dim
+        y = src[None, :, :] + chunk_translations[:, None, :]
+        error = (y - dst[None, :, :])
+        error *= error
+        l2 = np.sum(error, axis=2)
+
+        num_inliers = np.sum(l2 < threshold, axis=1)
+        best = np.argmax(num_inliers)
+        if num_inliers[best] > best_inliers:
+            best_inliers = num_inliers[best]
+            best_translation = chunk_translations[best]
+
+        if tried >= _hypotheses_needed(best_inliers / num_matches, confidence):
+            break
+
+    instrumentation.count('ransac_hypotheses', tried)
+    return _refine(src, dst, best_translation, threshold)
+
+
+def _refine(src, dst, best_translation, threshold, scales=(16., 4., 1.), max_rounds=20):
+    """
+        re-score the best hypothesis against all matches, moving it to
+        the mean translation of its inliers until they stop changing,
+        first with wider thresholds so that hypotheses from anywhere in
+        the same cluster of translations end at the same consensus.
+        Returns (inliers, translation) of the consensus
+    """
+    translations = dst - src
+
+    def inliers_of(translation, scale):
+        error = translations - translation
+        return np.sum(error * error, axis=1) < threshold * scale
+
+    for scale in scales:
+        inliers = inliers_of(best_translation, scale)
+        for _ in range(max_rounds):
+            if not inliers.any():
+                break
+            best_translation = translations[inliers].mean(axis=0).astype(src.dtype)
+            consensus_inliers = inliers_of(best_translation, scale)
+            if np.array_equal(consensus_inliers, inliers):
+                break
+            inliers = consensus_inliers
+    return int(np.sum(inliers_of(best_translation, 1.))), best_translation
+
+
+def _hypotheses_needed(inlier_ratio, confidence):
+    """
+        hypotheses to try to have picked at least one inlier with
+        probability confidence, each hypothesis being a single match
+    """
+    if confidence >= 1. or inlier_ratio <= 0.:
+        return np.inf
+    if inlier_ratio >= 1.:
+        return 1
+    return math.log(1. - confidence) / math.log(1. - inlier_ratio)
@@ -1,4 +1,5 @@
 from . import multi_modal_image
+from . import utils
 
 import os
 import csv
@@ -201,7 +202,41 @@ class InputPipeline:
     def __len__(self,):
         return len(self.triples_by_fov)
 
-    def as_multi_modal_objects(self, ):
+    def load_triples(self, triples, fov, resize):
+        """
+            yield a MultiModalImage per triple, the images are read
+            ahead on background threads at their native resolution
+        """
+        modalities = ['split', 'confocal', 'avg']
+        fnames = [triple[modality] for triple in triples for modality in modalities]
+        images = utils.load_many(fnames, None)
+        for triple in triples:
+            split, confocal, avg = next(images), next(images), next(images)
+            yield multi_modal_image.MultiModalImage(
+                triple['confocal'],
+                triple['split'],
+                triple['avg'],
+                triple['nominal'],
+                fov,
+                resize,
+                images=(split, confocal, avg))
+
+    def lazy_triples(self, triples, fov, resize):
+        """MultiModalImage per triple which only load pixels when used"""
+        for triple in triples:
+            yield multi_modal_image.MultiModalImage(
+                triple['confocal'],
+                triple['split'],
+                triple['avg'],
+                triple['nominal'],
+                fov,
+                resize,
+                lazy=True)
+
+    def as_multi_modal_objects(self, lazy=False):
+        """
+            lazy: dont load any pixels now, see MultiModalImage
+        """
         mm_dict = {}
 
         min_fov = min(list(self.triples_by_fov.keys()))
@@ -210,16 +245,11 @@ class InputPipeline:
                 resize = None
             else:
                 resize = fov / min_fov
-            mm_dict[fov] = [
-                multi_modal_image.MultiModalImage(
-                    triple['confocal'],
-                    triple['split'],
-                    triple['avg'],
-                    triple['nominal'],
-                    fov,
-                    resize)
-                for triple in self.triples_by_fov[fov]
-            ]
+            triples = self.triples_by_fov[fov]
+            if lazy:
+                mm_dict[fov] = list(self.lazy_triples(triples, fov, resize))
+            else:
+                mm_dict[fov] = list(self.load_triples(triples, fov, resize))
         mms = [ x for sublist in mm_dict.values() for x in sublist]
         mms_dict = {}
         mms_dict[min_fov] = mms
@@ -0,0 +1,203 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+
+def peak_rss():
+    """bytes of the largest resident set of this process so far"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # windows has neither
+        return 0
+    # kilobytes on linux, bytes on mac
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def reset_peak_rss():
+    """
+        start the peak resident set again from the current one, returns
+        False where that is not possible, when peaks are since the start
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class _Span:
+    """times what runs inside it, see Recorder.span"""
+
+    def __init__(self, recorder, name, attributes):
+        self.recorder = recorder
+        self.event = dict(name=name, **attributes)
+
+    def __enter__(self):
+        self.recorder._open(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.event['seconds'] = time.perf_counter() - self.start
+        self.recorder._close(self)
+        return False
+
+
+class _NoSpan:
+    """what span gives when nothing is being recorded"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Recorder:
+    """
+        Collects named spans, each the time and peak memory of a stage,
+        and counters, into a trace which can be saved as JSON.
+
+        Spans nest, and are meant for the stages of the pipeline run one
+        after another, the peak memory of a span includes the spans
+        inside it. Counters may be added to from any thread.
+    """
+    VERSION = 1
+
+    def __init__(self, profile=False):
+        """
+            profile: also run cProfile for as long as this is recording,
+                     saved next to the trace
+        """
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.events = []
+        self.counters = dict()
+        self._lock = threading.Lock()
+        self._stack = []
+
+        # the peak of the whole run, as resetting for each span loses it
+        self.peak = peak_rss()
+        self.per_span_peaks = reset_peak_rss()
+        self.profiler = cProfile.Profile() if profile else None
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def span(self, name, **attributes):
+        """context manager recording the time spent in it as an event"""
+        return _Span(self, name, attributes)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _open(self, span):
+        # the peak so far belongs to the spans already open
+        self._update_peaks()
+        span.event['parent'] = self._stack[-1].event['name'] if self._stack else None
+        span.event['start'] = time.perf_counter() - self._start
+        span.peak = 0
+        self._stack.append(span)
+        if self.per_span_peaks:
+            reset_peak_rss()
+
+    def _close(self, span):
+        self._update_peaks()
+        self._stack.remove(span)
+        span.event['peak_rss'] = span.peak
+        self.events.append(span.event)
+
+    def _update_peaks(self):
+        peak = peak_rss()
+        self.peak = max(self.peak, peak)
+        for span in self._stack:
+            span.peak = max(span.peak, peak)
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def trace(self):
+        """everything recorded, with the total time and calls of each span name"""
+        totals = dict()
+        for event in self.events:
+            total = totals.setdefault(event['name'], {'calls': 0, 'seconds': 0., 'peak_rss': 0})
+            total['calls'] += 1
+            total['seconds'] += event['seconds']
+            total['peak_rss'] = max(total['peak_rss'], event['peak_rss'])
+        return {
+            'version': Recorder.VERSION,
+            'started': self.started,
+            'seconds': time.perf_counter() - self._start,
+            'peak_rss': max(self.peak, peak_rss()),
+            'per_span_peaks': self.per_span_peaks,
+            'spans': sorted(self.events, key=lambda event: event['start']),
+            'totals': totals,
+            'counters': dict(self.counters),
+        }
+
+    def save(self, fname):
+        """write the trace to fname, and the profile if any to fname.prof"""
+        self.stop()
+        directory = os.path.dirname(os.path.abspath(fname))
+        os.makedirs(directory, exist_ok=True)
+        with open(fname, 'w') as f:
+            json.dump(self.trace(), f, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.splitext(fname)[0] + '.prof')
+
+
+# the recorder spans and counts go to, None when not recording
+recorder = None
+
+
+def start(profile=False):
+    """record from now on, returning the Recorder"""
+    global recorder
+    recorder = Recorder(profile)
+    return recorder
+
+
+def stop():
+    """stop recording, returning what was recorded"""
+    global recorder
+    stopped, recorder = recorder, None
+    if stopped is not None:
+        stopped.stop()
+    return stopped
+
+
+def span(name, **attributes):
+    """
+        context manager timing a stage, as
+
+            with instrumentation.span('registration', fov=fov):
+                ...
+
+        does nothing unless recording
+    """
+    if recorder is None:
+        return NO_SPAN
+    return recorder.span(name, **attributes)
+
+
+def count(name, n=1):
+    """add n to counter name, does nothing unless recording"""
+    if recorder is not None:
+        recorder.count(name, n)
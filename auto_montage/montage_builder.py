@@ -1,104 +1,99 @@
+from . import renderer
+from . import pyramid_writer
+
 import math
 import numpy as np
 import csv
 import matplotlib
 
 import os
+from scipy import sparse
 from scipy.sparse import csgraph
-from scipy import ndimage
+from scipy.sparse import linalg
 import random
 from PIL import Image
 
 class MontageBuilder:
     COMPONENT_BUILT = -1
-
-    def __init__(self, transformation_finder, evaluate=False):
+    SOLVERS = ('chain', 'lsq')
+
+    def __init__(self, transformation_finder, evaluate=False, solver='chain'):
+        """
+            solver: how each image is placed in its montage
+                'chain' add up the translations along the tree of
+                        accepted matches back to the global reference
+                'lsq' weighted least squares fit to every registration
+                      the search used with enough inliers, see
+                      solve_global_positions
+        """
+        if solver not in MontageBuilder.SOLVERS:
+            raise ValueError('No solver named {}'.format(solver))
+        self.solver = solver
         self.matched = transformation_finder.matched
-        self.translation = transformation_finder.translations
-        self.global_translation = np.zeros_like(self.translation)
+        self.registrations = transformation_finder.registrations
+        self.min_inliers = transformation_finder.min_inliers
         self.mm_images = transformation_finder.mmList
         self._num_im = len(self.mm_images)
-        
+
+        # image each one was matched to, roots are matched to themselves
+        self.parents = self.matched.ravel()
+
+        # (x, y) of every image relative to the global reference
+        # of its montage, filled by construct_all_montages
+        self.positions = np.zeros([self._num_im, 2])
+        self.labels = None
+        self._edges = None
+
     def connnected_components(self,):
-        graph = np.zeros([self._num_im,self._num_im], dtype=np.bool)
-        for i in range(self.matched.shape[0]):
-            graph[i, self.matched[i]] = True
+        """components of the tree of matches, one edge per image"""
+        image = np.arange(self._num_im)
+        graph = sparse.csr_matrix(
+            (np.ones([self._num_im], dtype=np.bool_), (image, self.parents)),
+            shape=(self._num_im, self._num_im))
         n, labels = csgraph.connected_components(graph, directed=False, return_labels=True)
         return n, labels
 
+    def _group(self, keys, n):
+        """
+            the indices of keys equal to each of 0 to n-1, in
+            increasing order, with one stable sort rather than a
+            scan per key
+        """
+        order = np.argsort(keys, kind='stable')
+        ends = np.cumsum(np.bincount(keys, minlength=n))
+        return np.split(order, ends[:-1])
+
     def construct_all_montages(self,):
         number_components, labels = self.connnected_components()
-        disjoint_montages = []
+        self.labels = labels
+        if self.solver == 'lsq':
+            self._edges = self._group_edges(number_components)
+        else:
+            self.chain_positions()
 
-        for component in range(number_components):
-            indices = np.argwhere(labels==component)
+        disjoint_montages = []
+        for component, indices in enumerate(self._group(labels, number_components)):
             transformations, indices = self.construct_component(indices, component)
             disjoint_montages.append((transformations, indices))
         return disjoint_montages
 
-    def _get_pairwise(self, indices):
-        # get all pairwise connections
-        connected_to = dict()
-        original_image = None
-        for dst_img in indices:
-            connected_to[dst_img] = []
-            for src_img in indices:
-
-                # find images which map to dst_img
-                if self.matched[src_img]==dst_img:
-                    connected_to[dst_img].append(src_img)
-
-                # get fixed image
-                if self.matched[dst_img]==dst_img:
-                    original_image = dst_img
-
-            # delete dict entry if empty
-            if len(connected_to[dst_img])==0:
-                connected_to.pop(dst_img, None)
-
-        return connected_to, original_image
-
-    def _choose_next_dst(self, current_dst, connected_to):
-        for key in connected_to.keys():
-            if key==current_dst:
-                continue
-            if key in connected_to[current_dst]:
-                return key, True
-        return None, False
-
-    def update_local_transformation(self, directly_connected, global_ref):
-
-        def recursiveTranslation(reference, global_trans):
-
-            # ending condition, which will always be met
-            # as this is a connected component
-            if reference in directly_connected[global_ref]:
-                return global_trans + self.translation[reference, global_ref]
-                
-
-            # find any element which contains local ref as src
-            # and align the ref to this, then look for how to
-            # align the new ref to global ref
-
-            for ref in directly_connected:
-                src_ims = directly_connected[ref]
-                if reference in src_ims:
-                    global_trans += self.translation[reference, ref]
-                    global_trans = recursiveTranslation(ref, global_trans)
-                    break
-            return global_trans
-
-        global_trans_dict = dict()
-        for ref in directly_connected:
-            src_ims = directly_connected[ref]
-            global_trans = np.array([0.,0.])
-            global_trans = recursiveTranslation(ref, global_trans)
-            global_trans_dict[ref] = global_trans
-
-        for ref in directly_connected:
-            src_ims = directly_connected[ref]
-            for src in src_ims:
-                self.translation[src, ref] += global_trans_dict[ref]
+    def chain_positions(self,):
+        """
+            position every image by adding up the translations along
+            the tree of matches, visiting each image once, parents
+            before their children
+        """
+        children = self._group(self.parents, self._num_im)
+        roots = np.flatnonzero(self.parents == np.arange(self._num_im))
+        self.positions[roots] = 0.
+
+        queue = list(roots)
+        for parent in queue:
+            for child in children[parent]:
+                if child == parent:
+                    continue
+                self.positions[child] = self.registrations.get_translation(child, parent) + self.positions[parent]
+                queue.append(child)
 
     def get_transformation(self, indices):
         transformations = []
@@ -111,9 +106,8 @@ class MontageBuilder:
             avg = self.mm_images[src_id].get_avg_name()
 
             # translation
-            dst_id = self.matched[src_id]
-            t = self.translation[src_id, dst_id]
-            y, x = t[0,0], t[0,1]
+            t = self.positions[src_id]
+            y, x = t[0], t[1]
 
             # put into dict and write
             row['confocal'] = confocal
@@ -121,60 +115,88 @@ class MontageBuilder:
             row['avg'] = avg
             row['transy'] = y
             row['transx'] = x
-            row['h'] = self.mm_images[src_id].get_confocal().shape[0]
-            row['w'] = self.mm_images[src_id].get_confocal().shape[1]
+            row['h'], row['w'] = self.mm_images[src_id].get_shape()
 
             transformations.append(row)
         return transformations
 
+    def _group_edges(self, number_components):
+        """
+            every registration the greedy search used with more inliers
+            than needed to be accepted, between images of the same
+            component, as src, dst, translation, inliers for each
+            component. Registrations only computed ahead on a guess are
+            left out, so the positions do not depend on the workers
+        """
+        src, dst, inliers, translations = self.registrations.edges(used_only=True)
+        keep = (inliers > self.min_inliers) & (src != dst)
+        keep &= self.labels[src] == self.labels[dst]
+        src, dst = src[keep], dst[keep]
+        inliers, translations = inliers[keep], translations[keep]
+
+        edges = []
+        for edge in self._group(self.labels[src], number_components):
+            edges.append((src[edge], dst[edge], translations[edge], inliers[edge]))
+        return edges
+
+    def solve_global_positions(self, indices, global_ref, edges):
+        """
+            position of every image of a component, global_ref fixed at
+            the origin, minimising the sum over edges of
+                inliers * |position[src] - position[dst] - translation|^2
+            solved as the sparse normal equations (a weighted graph
+            laplacian), so every registration is used rather than just
+            those of the tree, and errors dont add up along chains
+        """
+        positions = {global_ref: np.zeros([2])}
+        others = [x for x in indices if x != global_ref]
+        if len(others) == 0:
+            return positions
+
+        # column of each image in the system, the reference has none
+        column = -np.ones([self._num_im], dtype=np.int64)
+        column[others] = np.arange(len(others))
+
+        src, dst, translation, inliers = edges
+        s, d = column[src], column[dst]
+        w = inliers.astype(np.float64)
+
+        # laplacian entries of each edge, dropping the reference
+        rows = np.concatenate([s, d, s, d])
+        cols = np.concatenate([s, d, d, s])
+        vals = np.concatenate([w, w, -w, -w])
+        keep = (rows >= 0) & (cols >= 0)
+        laplacian = sparse.coo_matrix(
+            (vals[keep], (rows[keep], cols[keep])),
+            shape=(len(others), len(others))).tocsc()
+
+        rhs = np.zeros([len(others), 2])
+        np.add.at(rhs, s[s >= 0], w[s >= 0, None] * translation[s >= 0])
+        np.add.at(rhs, d[d >= 0], -w[d >= 0, None] * translation[d >= 0])
+
+        solution = linalg.splu(laplacian).solve(rhs)
+        for image, position in zip(others, solution):
+            positions[image] = position
+        return positions
+
     def construct_component(self, indices, idx):
         # make into iterable list
         indices = list(indices.ravel())
 
-        # get first pairwise connections
-        directly_connected, global_ref = self._get_pairwise(indices)
-
-        # construct gobal transformation
-        self.update_local_transformation(directly_connected, global_ref)
+        # least squares positions, the chain ones are already set
+        if self.solver == 'lsq':
+            global_ref = indices[int(np.flatnonzero(self.parents[indices] == indices)[0])]
+            positions = self.solve_global_positions(indices, global_ref, self._edges[idx])
+            for src_id in indices:
+                self.positions[src_id] = positions[src_id]
 
         # write transformation to file
         transformations = self.get_transformation(indices)
 
         return transformations, indices
 
-    def transform_box(self, src, dst, box):
-        transform = self.translation[src, dst]
-        return box + transform
-
-    def _get_global_box(self, indices):
-        """bounding box size for a chunk after making transformation global"""
-        global_x_min = np.infty
-        global_x_max = -np.infty
-        global_y_min = np.infty
-        global_y_max = -np.infty
-        for src_id in indices:
-            # get vals
-            src_img = self.mm_images[src_id]
-            dst_id = self.matched[src_id]
-            h, w = src_img.get_confocal().shape
-
-            # transform box and find values
-            bounding_box = np.array([[0,0], [0, h-1], [w-1, 0], [w-1, h-1]])
-            transfor_box = self.transform_box(src_id, dst_id, bounding_box)
-            x_min, y_min = np.min(transfor_box, axis=0)
-            x_max, y_max = np.max(transfor_box, axis=0)
-
-            # update global box
-            global_x_min = x_min if x_min < global_x_min else global_x_min
-            global_y_min = y_min if y_min < global_y_min else global_y_min
-            global_x_max = x_max if x_max > global_x_max else global_x_max
-            global_y_max = y_max if y_max > global_y_max else global_y_max
-
-        return int(global_x_min), int(global_x_max), int(global_y_min), int(global_y_max)
-
-    def setup_folders(self, indice_list, subject):
-        eval_directory = '/media/benjamin/Seagate Backup Plus Drive/montageWithPiece'
-        directory = os.path.join(eval_directory, subject)
+    def setup_folders(self, indice_list, subject, directory):
+        directory = os.path.join(directory, subject)
         os.makedirs(directory)
 
         for idx, val in enumerate(indice_list):
@@ -182,90 +204,138 @@ class MontageBuilder:
                 new_dir = os.path.join(directory, str(idx), modality)
                 os.makedirs(new_dir)
 
-    def build_fname(self, subject, mntge_type, idx, fname):
+    def build_fname(self, directory, subject, mntge_type, idx, fname):
         # build save path
-        eval_directory = '/media/benjamin/Seagate Backup Plus Drive/montageWithPiece'
-        save_path = os.path.join(eval_directory, subject, str(idx), mntge_type, fname)
+        save_path = os.path.join(directory, subject, str(idx), mntge_type, fname)
         return save_path
 
-    def saveImWithAlpha(self, im, alpha, subject, mntge_type, idx, fname):
+    def save_piece(self, piece, directory, subject, mntge_type, idx, fname):
+        fname = os.path.basename(fname)
+        save_path = self.build_fname(directory, subject, mntge_type, idx, fname)
+        Image.fromarray(np.uint8(piece)).save(save_path)
 
-        fname = fname.split('/')[-1]
-        save_path = self.build_fname(subject, mntge_type, idx, fname)
-
-        # convert image to pil LA image
-        im = np.uint8(im)
-        im = Image.fromarray(im)
-        im = im.convert('LA')
-
-        # convert alpha mask to L
-        alpha = np.uint8(alpha*255)
-        alpha_im = Image.fromarray(alpha)
-        alpha_im = alpha_im.convert('L')
-
-        # build and save
-        im.putalpha(alpha_im)
-        im.save(save_path)
+    def save_offsets(self, offsets, directory, subject, mntge_type, idx):
+        """where each piece goes in the full montage, as name, x, y"""
+        save_path = self.build_fname(directory, subject, mntge_type, idx, 'pieces.csv')
+        with open(save_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'x', 'y'])
+            writer.writerows(offsets)
 
-    def save_montage(self, montage, subject, mntge_type, idx):
-        save_path = self.build_fname(subject, mntge_type, idx, 'full.tiff')
+    def save_montage(self, montage, directory, subject, mntge_type, idx):
+        save_path = self.build_fname(directory, subject, mntge_type, idx, 'full.tiff')
 
-        # convert image to pil LA image
+        # single channel 8 bit image
         montage = np.uint8(montage)
         im = Image.fromarray(montage)
         im.save(save_path)
 
-    def save_pieces(self, indices_list, subject):
+    def _modality_images(self, indices, mntge_type):
+        """pixels of a modality of each image of a component, by position in indices"""
+        def images(k):
+            return self.mm_images[indices[k]].get_modality(mntge_type)
+        return images
+
+    def _layout(self, indices, tile_renderer):
+        """
+            canvas box of a component and the footprint of each of its
+            images, which are enlarged to the montage frame as they are
+            shifted
+        """
+        positions = self.positions[list(indices)]
+        mm_images = [self.mm_images[src_id] for src_id in indices]
+        shapes = [mm.get_shape() for mm in mm_images]
+        scales = [mm.frame_scale() if mm.resize is not None else None for mm in mm_images]
+        box = renderer.bounding_box(positions, shapes)
+        return box, tile_renderer.tiles(positions, shapes, box, scales)
+
+    def save_pyramids(self, indices_list, directory, workers=None):
+        """
+            render every montage and modality onto a canvas backed by a
+            temporary file and write it to directory as a tiled,
+            pyramidal BigTIFF montage_idx_modality.tif, without ever
+            holding a whole montage in memory. Returns the file names
+        """
+        os.makedirs(directory, exist_ok=True)
+        tile_renderer = renderer.TileRenderer(workers)
+        writer = pyramid_writer.PyramidWriter()
+
+        fnames = []
+        for idx, indices in enumerate(indices_list):
+            box, tiles = self._layout(indices, tile_renderer)
+            gx_min, gx_max, gy_min, gy_max = box
+
+            for mntge_type in ['confocal', 'split', 'avg']:
+                canvas = pyramid_writer.open_canvas([gy_max-gy_min, gx_max-gx_min], directory)
+                images = self._modality_images(indices, mntge_type)
+                tile_renderer.render(images, tiles, box, canvas)
+
+                fname = os.path.join(directory, 'montage_{}_{}.tif'.format(idx, mntge_type))
+                writer.write(fname, canvas)
+                fnames.append(fname)
+                del canvas
+        return fnames
+
+    def save_previews(self, indices_list, directory, name='preview', scale=0.125,
+                      modality='confocal', workers=None):
+        """
+            quick look at every montage, each image shrunk by scale and
+            pasted at its scaled position, written to directory as
+            name_idx.png. The previews of the images are freed once
+            their montage is written. Returns the file names
+        """
+        os.makedirs(directory, exist_ok=True)
+        tile_renderer = renderer.TileRenderer(workers)
+
+        fnames = []
+        for idx, indices in enumerate(indices_list):
+            positions = self.positions[list(indices)] * scale
+            shapes = [self.mm_images[src_id].get_preview_shape(scale) for src_id in indices]
+            box = renderer.bounding_box(positions, shapes)
+            tiles = tile_renderer.tiles(positions, shapes, box)
+            images = self._preview_images(indices, modality, scale)
+            preview = tile_renderer.render(images, tiles, box)
+
+            fname = os.path.join(directory, '{}_{}.png'.format(name, idx))
+            Image.fromarray(preview).save(fname)
+            fnames.append(fname)
+            for src_id in indices:
+                self.mm_images[src_id].release_previews()
+        return fnames
+
+    def _preview_images(self, indices, mntge_type, scale):
+        def images(k):
+            return self.mm_images[indices[k]].get_preview(mntge_type, scale)
+        return images
+
+    def save_pieces(self, indices_list, subject, directory, workers=None):
+        """
+            render every montage and modality to directory/subject/idx/modality
+            as full.tiff, each image cropped to the part of the montage it
+            covers, and pieces.csv giving where each of them goes
+        """
 
         # setup all folders for the subject montage
-        self.setup_folders(indices_list, subject)
+        self.setup_folders(indices_list, subject, directory)
+        tile_renderer = renderer.TileRenderer(workers)
 
         for idx, indices in enumerate(indices_list):
 
             # build global coordinates
-            gx_min, gx_max, gy_min, gy_max = self._get_global_box(indices)
-            grid_x, grid_y = np.meshgrid(
-                np.arange(gx_min, gx_max), 
-                np.arange(gy_min, gy_max),
-                )
-            montage = np.zeros([gy_max-gy_min, gx_max-gx_min])
+            box, tiles = self._layout(indices, tile_renderer)
+            gx_min, gx_max, gy_min, gy_max = box
 
             for mntge_type in ['confocal', 'split', 'avg']:
-
-                for src_id in indices:
-                    src_img, src_name = self.mm_images[src_id].get_image_and_name(mntge_type)
-                    dst_id = self.matched[src_id]
-
-                    # mask to form alpha channel
-                    src_mask = np.ones(src_img.shape)
-                    
-                    # actual translation
-                    t = self.translation[src_id, dst_id]
-
-                    # move image and mask
-                    warped_image = ndimage.map_coordinates(
-                        src_img,
-                        [grid_y-t[0,1], grid_x-t[0,0]],
-                        order=3,
-                        cval=0.0,)
-
-                    warped_mask = ndimage.map_coordinates(
-                        src_mask,
-                        [grid_y-t[0,1], grid_x-t[0,0]],
-                        order=1,
-                        cval=0.0,)
-
-                    self.saveImWithAlpha(warped_image, warped_mask, subject, mntge_type, idx, src_name)
-                    montage = np.where(warped_mask > 0, warped_image, montage)
-
-                self.save_montage(montage, subject, mntge_type, idx)
-                    
-                    
-                    
-        
-
-
-
-
-
-        
\ No newline at end of file
+                montage = np.zeros([gy_max-gy_min, gx_max-gx_min], dtype=np.uint8)
+                images = self._modality_images(indices, mntge_type)
+                offsets = []
+
+                # later images are pasted over earlier ones
+                for piece, (k, (top, left, rows, cols), start, scale) in tile_renderer.pieces(images, tiles):
+                    src_name = self.mm_images[indices[k]].get_name(mntge_type)
+                    self.save_piece(piece, directory, subject, mntge_type, idx, src_name)
+                    offsets.append([os.path.basename(src_name), left, top])
+                    montage[top:top + rows, left:left + cols] = piece
+
+                self.save_offsets(offsets, directory, subject, mntge_type, idx)
+                self.save_montage(montage, directory, subject, mntge_type, idx)
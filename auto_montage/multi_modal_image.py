@@ -1,30 +1,185 @@
 from . import utils
 from . import features
+from . import feature_cache
 
 import numpy as np
+import cv2
+import collections
+import threading
+
+
+class PixelCache:
+    """
+        Least recently used store of the pixels of lazy MultiModalImage
+        objects, shared between all of them. Once over max_bytes the
+        least recently used images are dropped, to be reloaded from
+        disk the next time they are needed
+    """
+
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._pixels = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, mm):
+        with self._lock:
+            pixels = self._pixels.get(mm)
+            if pixels is not None:
+                self._pixels.move_to_end(mm)
+            return pixels
+
+    def put(self, mm, pixels):
+        with self._lock:
+            self._discard(mm)
+            self._pixels[mm] = pixels
+            self.nbytes += pixels.nbytes
+
+            # always keep the image just added
+            while self.nbytes > self.max_bytes and len(self._pixels) > 1:
+                _, dropped = self._pixels.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+
+    def discard(self, mm):
+        with self._lock:
+            self._discard(mm)
+
+    def _discard(self, mm):
+        pixels = self._pixels.pop(mm, None)
+        if pixels is not None:
+            self.nbytes -= pixels.nbytes
 
 
 class MultiModalImage:
     index = {'split':0, 'confocal':1, 'avg':2}
 
-    def __init__(self, confocal, split, avg, nominal_position, fov, resize):
+    # shared on disk keypoint/descriptor store, set to None to disable
+    feature_cache = feature_cache.FeatureCache()
+
+    # shared memory budget for the pixels of lazy images
+    pixel_cache = PixelCache()
+
+    def __init__(self, confocal, split, avg, nominal_position, fov, resize, images=None, lazy=False):
         """
             store names, nominal position and images as a single
             numpy tensor [height, width, channel]
+            resize: factor from the pixels of this image to the frame
+                    shared by every image of the montage, None if the
+                    same. Pixels are kept at their native resolution,
+                    keypoints, shapes and translations are in the
+                    shared frame
+            images: optional already loaded (split, confocal, avg)
+            lazy: if True the pixels are not loaded until first used,
+                  and are then held in the shared pixel_cache which
+                  may drop them and reload them later
         """
         self.fov = fov
         self.split_fname = split
         self.confocal_fname = confocal
         self.avg_fname = avg
-        split = utils.load_from_fname(split, resize)
-        confocal = utils.load_from_fname(confocal, resize)
-        avg = utils.load_from_fname(avg, resize)
-        self.multimodal_im = np.stack([split, confocal, avg], axis=2)
+        self.resize = resize
+        self.lazy = lazy
+        self.shape = None
+        self.native_shape = None
+        self._digests = dict()
+        self._pixels = None
+        self._pixel_lock = threading.Lock()
+        if images is not None:
+            self._set_pixels(np.stack(images, axis=2))
+        elif not lazy:
+            self._set_pixels(self._load_pixels())
         self.nominal_position = nominal_position
 
+        # float32 [n, 2] (x, y) of the keypoints and their descriptors
         self.keypoints = {'split':None, 'confocal':None, 'avg':None}
         self.descriptors = {'split':None, 'confocal':None, 'avg':None}
 
+        # LSH index over the descriptors, built the first time this
+        # image is matched against and kept while it can be matched to
+        self.matchers = {'split':None, 'confocal':None, 'avg':None}
+        self._matcher_lock = threading.Lock()
+
+        # small copies for quick look previews, by (modality, scale)
+        self.previews = dict()
+
+    def _load_pixels(self,):
+        split = utils.load_from_fname(self.split_fname, None)
+        confocal = utils.load_from_fname(self.confocal_fname, None)
+        avg = utils.load_from_fname(self.avg_fname, None)
+        return np.stack([split, confocal, avg], axis=2)
+
+    def _set_pixels(self, pixels):
+        self.native_shape = pixels.shape[:2]
+        self.shape = utils.scaled_shape(self.native_shape, self.resize)
+        if self.lazy:
+            MultiModalImage.pixel_cache.put(self, pixels)
+        else:
+            self._pixels = pixels
+
+    @property
+    def multimodal_im(self,):
+        """[height, width, channel] pixels, loaded from disk if not in memory"""
+        return self.load_pixels()
+
+    def load_pixels(self,):
+        """
+            the [height, width, channel] pixels, reading them from disk
+            into the pixel cache if they are not in memory
+        """
+        if not self.lazy:
+            return self._pixels
+        with self._pixel_lock:
+            pixels = MultiModalImage.pixel_cache.get(self)
+            if pixels is None:
+                pixels = self._load_pixels()
+                self._set_pixels(pixels)
+            return pixels
+
+    def release_pixels(self,):
+        """
+            free the pixels, e.g. once features are computed. The image
+            becomes lazy so they are reloaded if needed for rendering
+        """
+        with self._pixel_lock:
+            self.lazy = True
+            self._pixels = None
+            MultiModalImage.pixel_cache.discard(self)
+
+    def get_shape(self,):
+        """(height, width) in the montage frame, without loading the pixels"""
+        if self.shape is None:
+            self.shape = utils.shape_from_fname(self.confocal_fname, self.resize)
+        return self.shape
+
+    def get_native_shape(self,):
+        """(height, width) of the pixels, without loading them"""
+        if self.native_shape is None:
+            self.native_shape = utils.shape_from_fname(self.confocal_fname, None)
+        return self.native_shape
+
+    def frame_scale(self,):
+        """(x, y) factor from the pixels to the montage frame"""
+        h, w = self.get_shape()
+        native_h, native_w = self.get_native_shape()
+        return np.array([w / native_w, h / native_h])
+
+    def to_montage_frame(self, coordinates):
+        """
+            (x, y) pixel coordinates in the montage frame, where
+            cv2.resize would have put them
+        """
+        if self.resize is None:
+            return coordinates
+        return ((coordinates + 0.5) * self.frame_scale() - 0.5).astype(np.float32)
+
+    def get_scaled_modality(self, modality):
+        """a modality resized to the montage frame"""
+        image = self.get_modality(modality)
+        if self.resize is None:
+            return image
+        h, w = self.get_shape()
+        return cv2.resize(image, (w, h))
+
     def get_confocal(self,):
         return self.multimodal_im[:,:,MultiModalImage.index['confocal']]
 
@@ -60,13 +215,92 @@ class MultiModalImage:
             raise ValueError('No type named {}'.format(mntge_type))
         return src_img, src_name
 
+    def get_modality(self, modality):
+        return self.multimodal_im[:,:,MultiModalImage.index[modality]]
+
+    def get_name(self, modality):
+        names = {
+            'split': self.split_fname,
+            'confocal': self.confocal_fname,
+            'avg': self.avg_fname,
+        }
+        return names[modality]
+
+    def get_preview_shape(self, scale):
+        """(height, width) of the previews at scale"""
+        h, w = self.get_shape()
+        return max(1, int(round(h * scale))), max(1, int(round(w * scale)))
+
+    def get_preview(self, modality, scale):
+        """the modality in the montage frame shrunk by scale, kept until release_previews"""
+        key = (modality, scale)
+        if key not in self.previews:
+            h, w = self.get_preview_shape(scale)
+            self.previews[key] = cv2.resize(
+                self.get_modality(modality), (w, h), interpolation=cv2.INTER_AREA)
+        return self.previews[key]
+
+    def release_previews(self,):
+        """free the previews, once the montage previews are written"""
+        self.previews = dict()
+
+    def set_features(self, modality, kps, desc):
+        self.keypoints[modality] = kps
+        self.descriptors[modality] = desc
+        self.matchers[modality] = None
+
+    def get_matcher(self, modality):
+        """index for matching other images to this one, built on first use"""
+        with self._matcher_lock:
+            if self.matchers[modality] is None:
+                self.matchers[modality] = features.build_index(self.descriptors[modality])
+            return self.matchers[modality]
+
+    def release_matchers(self,):
+        with self._matcher_lock:
+            for modality in self.matchers.keys():
+                self.matchers[modality] = None
+
+    def _cache_key(self, modality):
+        if modality not in self._digests:
+            self._digests[modality] = feature_cache.file_digest(self.get_name(modality))
+        return MultiModalImage.feature_cache.key(
+            self._digests[modality], modality, self.resize, features.ORB_PARAMS)
+
+    def load_cached_features(self, modality):
+        """set the features from the feature cache, True if they were there"""
+        if MultiModalImage.feature_cache is None:
+            return False
+        cached = MultiModalImage.feature_cache.get(self._cache_key(modality))
+        if cached is None:
+            return False
+        kps, desc = cached
+        self.set_features(modality, kps, desc)
+        return True
+
+    def cache_features(self, modality):
+        if MultiModalImage.feature_cache is None:
+            return
+        MultiModalImage.feature_cache.put(
+            self._cache_key(modality), self.keypoints[modality], self.descriptors[modality])
+
+    def calculate_modality_orb(self, modality):
+        """calculate and set the descriptors of a single modality"""
+        if self.load_cached_features(modality):
+            return
+        self.compute_modality_orb(modality)
+
+    def compute_modality_orb(self, modality):
+        """compute the descriptors of a modality, not looking in the cache first"""
+        kps, desc = features.compute_kps_desc(self.get_modality(modality))
+        kps = self.to_montage_frame(features.keypoint_coordinates(kps))
+        self.set_features(modality, kps, desc)
+        self.cache_features(modality)
+
     def calculate_orb(self,):
         """calculate and set the descriptors"""
         for modality in self.keypoints.keys():
-            image = self.multimodal_im[:,:,MultiModalImage.index[modality]]
-            kps, desc = features.compute_kps_desc(image)
-            self.keypoints[modality] = kps
-            self.descriptors[modality] = desc
+            self.calculate_modality_orb(modality)
 
 
 
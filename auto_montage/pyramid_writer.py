@@ -0,0 +1,179 @@
+import numpy as np
+import cv2
+
+import math
+import os
+import struct
+import tempfile
+import zlib
+
+
+# tiff tag types
+SHORT = 3
+LONG = 4
+LONG8 = 16
+
+# reduced resolution copy of another image in the file
+REDUCED_IMAGE = 1
+
+COMPRESSION = {None: 1, 'deflate': 8}
+
+
+def open_canvas(shape, directory=None):
+    """
+        uint8 canvas of shape (rows, cols) zero filled and backed by a
+        temporary file in directory, so it need not fit in memory. The
+        file is already unlinked where the os allows it
+    """
+    f = tempfile.TemporaryFile(dir=directory)
+    f.truncate(max(shape[0] * shape[1], 1))
+    return np.memmap(f, dtype=np.uint8, mode='r+', shape=tuple(shape))
+
+
+def downsample(image, directory=None, band_rows=1024):
+    """
+        image at half the size, each pixel the mean of a 2x2 block,
+        into a new canvas, band_rows rows of image at a time
+    """
+    rows, cols = image.shape
+    half = open_canvas((int(math.ceil(rows / 2.)), int(math.ceil(cols / 2.))), directory)
+    band_rows += band_rows % 2
+    for top in range(0, rows, band_rows):
+        band = np.asarray(image[top:top + band_rows])
+        # repeat the last row and column of odd sizes
+        if band.shape[0] % 2:
+            band = np.concatenate([band, band[-1:]], axis=0)
+        if band.shape[1] % 2:
+            band = np.concatenate([band, band[:, -1:]], axis=1)
+        small = cv2.resize(band, (band.shape[1] // 2, band.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        half[top // 2:top // 2 + small.shape[0]] = small
+    return half
+
+
+class PyramidWriter:
+    """
+        Writes uint8 greyscale images as tiled, pyramidal BigTIFF files,
+        which hold images of any size and let viewers read any region at
+        any resolution. The full image is the first page, followed by
+        pages of half the size of the one before until it fits in a
+        single tile, each marked as a reduced resolution image.
+
+        Images are read and written one band of tiles at a time and the
+        reduced resolutions go to temporary files, so memory does not
+        depend on the size of the image.
+    """
+
+    def __init__(self, tile_size=256, compression='deflate', level=6):
+        """
+            tile_size: side of the square tiles, a multiple of 16
+            compression: 'deflate' or None
+            level: zlib compression level
+        """
+        if tile_size % 16:
+            raise ValueError('Tile size must be a multiple of 16, not {}'.format(tile_size))
+        if compression not in COMPRESSION:
+            raise ValueError('No compression named {}'.format(compression))
+        self.tile_size = tile_size
+        self.compression = compression
+        self.level = level
+
+    def levels(self, shape):
+        """shapes of each page of the pyramid"""
+        shapes = [tuple(shape)]
+        while max(shapes[-1]) > self.tile_size:
+            rows, cols = shapes[-1]
+            shapes.append((int(math.ceil(rows / 2.)), int(math.ceil(cols / 2.))))
+        return shapes
+
+    def _tiles(self, image):
+        """every tile of image, padded to full size, in row major order"""
+        rows, cols = image.shape
+        size = self.tile_size
+        for top in range(0, rows, size):
+            band = np.asarray(image[top:top + size])
+            for left in range(0, cols, size):
+                tile = np.zeros([size, size], dtype=np.uint8)
+                piece = band[:, left:left + size]
+                tile[:piece.shape[0], :piece.shape[1]] = piece
+                data = tile.tobytes()
+                if self.compression == 'deflate':
+                    data = zlib.compress(data, self.level)
+                yield data
+
+    def _write_page(self, f, image, subfile_type):
+        """tile data then directory of one page, returns where the directory is"""
+        offsets = []
+        byte_counts = []
+        for data in self._tiles(image):
+            offsets.append(f.tell())
+            byte_counts.append(len(data))
+            f.write(data)
+
+        # arrays too long to fit in their entry go before the directory
+        arrays = dict()
+        for tag, values in ((324, offsets), (325, byte_counts)):
+            if len(values) > 1:
+                arrays[tag] = f.tell()
+                f.write(struct.pack('<{}Q'.format(len(values)), *values))
+
+        rows, cols = image.shape
+        entries = [
+            (254, LONG, [subfile_type]),
+            (256, LONG, [cols]),
+            (257, LONG, [rows]),
+            (258, SHORT, [8]),
+            (259, SHORT, [COMPRESSION[self.compression]]),
+            # black is zero
+            (262, SHORT, [1]),
+            (277, SHORT, [1]),
+            (284, SHORT, [1]),
+            (322, LONG, [self.tile_size]),
+            (323, LONG, [self.tile_size]),
+            (324, LONG8, offsets),
+            (325, LONG8, byte_counts),
+        ]
+
+        if f.tell() % 2:
+            f.write(b'\0')
+        directory = f.tell()
+        f.write(struct.pack('<Q', len(entries)))
+        for tag, kind, values in entries:
+            if tag in arrays:
+                value = struct.pack('<Q', arrays[tag])
+            else:
+                fmt = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}[kind]
+                value = struct.pack('<{}{}'.format(len(values), fmt), *values).ljust(8, b'\0')
+            f.write(struct.pack('<HHQ', tag, kind, len(values)) + value)
+
+        # the next directory, patched when there is one
+        f.write(struct.pack('<Q', 0))
+        return directory
+
+    def write(self, fname, image, temp_directory=None):
+        """
+            write image, a 2d uint8 array or memmap, and its reduced
+            resolutions to fname
+        """
+        if temp_directory is None:
+            temp_directory = os.path.dirname(os.path.abspath(fname))
+        with open(fname, 'wb') as f:
+            # little endian BigTIFF header, the first directory is patched in
+            f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+            link = 8
+
+            page = image
+            subfile_type = 0
+            for _ in self.levels(image.shape):
+                if page is not image:
+                    subfile_type = REDUCED_IMAGE
+                directory = self._write_page(f, page, subfile_type)
+
+                # point the previous directory, or the header, at this one
+                end = f.tell()
+                f.seek(link)
+                f.write(struct.pack('<Q', directory))
+                f.seek(end)
+                link = end - 8
+
+                if max(page.shape) > self.tile_size:
+                    page = downsample(page, temp_directory)
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class RegistrationStore:
+    """
+        The registrations computed between pairs of images, kept as
+        growing arrays of (src, dst, inliers, translation) with a dict
+        from each pair to its row. Memory grows with the number of pairs
+        registered, rather than with the square of the number of images.
+
+        Registrations the greedy search actually looked at are marked
+        used. Those computed ahead of time on a guess that were never
+        needed are not, so the used ones are the same however many
+        workers registered them.
+
+        A translation takes points of src to dst, so the registration of
+        (j, i) is that of (i, j) negated with the same number of inliers,
+        and only one of the two is ever stored.
+    """
+
+    def __init__(self, capacity=1024):
+        self.src = np.zeros([capacity], dtype=np.int32)
+        self.dst = np.zeros([capacity], dtype=np.int32)
+        self.inliers = np.zeros([capacity], dtype=np.int16)
+        self.translations = np.zeros([capacity, 2])
+        self.used = np.zeros([capacity], dtype=np.bool_)
+        self.n = 0
+        self._rows = dict()
+
+    def __len__(self,):
+        return self.n
+
+    def _grow(self,):
+        capacity = 2 * self.src.shape[0]
+        for name in ('src', 'dst', 'inliers', 'translations', 'used'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def add(self, i, j, inliers, translation):
+        """store the registration of i to j, replacing any of i to j or j to i"""
+        row = self._rows.get((i, j))
+        sign = 1.
+        if row is None:
+            row = self._rows.get((j, i))
+            sign = -1.
+        if row is None:
+            if self.n == self.src.shape[0]:
+                self._grow()
+            row = self.n
+            self.n += 1
+            self.src[row], self.dst[row] = i, j
+            self._rows[(i, j)] = row
+            sign = 1.
+        self.inliers[row] = inliers
+        self.translations[row] = sign * np.asarray(translation).reshape(2)
+
+    def computed(self, i, j):
+        return (i, j) in self._rows or (j, i) in self._rows
+
+    def mark_used(self, i, j):
+        """mark the registration of i to j, if computed, as used"""
+        row = self._rows.get((i, j))
+        if row is None:
+            row = self._rows.get((j, i))
+        if row is not None:
+            self.used[row] = True
+
+    def get_inliers(self, i, j):
+        """inliers of the registration of i to j, 0 if not computed"""
+        row = self._rows.get((i, j))
+        if row is None:
+            row = self._rows.get((j, i))
+        if row is None:
+            return 0
+        return self.inliers[row]
+
+    def get_translation(self, i, j):
+        """translation taking points of i to j, zero if not computed"""
+        row = self._rows.get((i, j))
+        if row is not None:
+            return self.translations[row].copy()
+        row = self._rows.get((j, i))
+        if row is not None:
+            return -self.translations[row]
+        return np.zeros([2])
+
+    def _order(self,):
+        return np.lexsort((self.dst[:self.n], self.src[:self.n]))
+
+    def edges(self, used_only=False):
+        """
+            src, dst, inliers, translations of every stored registration,
+            or only of those marked used, sorted by (src, dst)
+        """
+        order = self._order()
+        if used_only:
+            order = order[self.used[order]]
+        return (self.src[order], self.dst[order],
+                self.inliers[order], self.translations[order])
+
+    def used_flags(self,):
+        """whether each registration of edges() is marked used"""
+        return self.used[self._order()]
@@ -0,0 +1,136 @@
+from . import utils
+
+import numpy as np
+import cv2
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def bounding_box(positions, shapes):
+    """
+        (x_min, x_max, y_min, y_max) of images of shapes (h, w) at
+        positions (x, y), truncated to integers
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    shapes = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+    lower = positions.min(axis=0)
+    upper = (positions + shapes[:, ::-1] - 1).max(axis=0)
+    return int(lower[0]), int(upper[0]), int(lower[1]), int(upper[1])
+
+
+def footprint(position, shape, box):
+    """
+        the canvas pixels an image of shape (h, w) at position (x, y)
+        covers, on the canvas of box, as (top, left, rows, cols) and the
+        (x, y) of the image sampled at canvas pixel (top, left). Only
+        pixels whose centre lands on the image are covered, or None if
+        there are none
+    """
+    x_min, x_max, y_min, y_max = box
+    h, w = shape
+    x, y = position[0] - x_min, position[1] - y_min
+    left = max(int(math.ceil(x)), 0)
+    top = max(int(math.ceil(y)), 0)
+    right = min(int(math.floor(x + w - 1)), x_max - x_min - 1)
+    bottom = min(int(math.floor(y + h - 1)), y_max - y_min - 1)
+    if right < left or bottom < top:
+        return None
+    return (top, left, bottom - top + 1, right - left + 1), (left - x, top - y)
+
+
+def shift_image(image, start, size, scale=None, interpolation=cv2.INTER_CUBIC):
+    """
+        size (rows, cols) pixels of image sampled from start (x, y).
+        A whole number start is a plain crop, otherwise the image is
+        resampled over the pixels needed only.
+
+        scale: (x, y) factor the image is enlarged by first, in the
+               same step, with start in the enlarged image
+    """
+    rows, cols = size
+    x, y = start
+    if scale is None:
+        if x == int(x) and y == int(y):
+            x, y = int(x), int(y)
+            return image[y:y + rows, x:x + cols]
+        scale = (1., 1.)
+
+    # pixel centres as cv2.resize places them
+    scale_x, scale_y = scale
+    transform = np.array([
+        [1. / scale_x, 0., (x + 0.5) / scale_x - 0.5],
+        [0., 1. / scale_y, (y + 0.5) / scale_y - 0.5]])
+    return cv2.warpAffine(
+        image, transform, (cols, rows),
+        flags=interpolation | cv2.WARP_INVERSE_MAP,
+        borderMode=cv2.BORDER_REFLECT_101)
+
+
+class TileRenderer:
+    """
+        Renders montages of translated images. Each image is only
+        resampled over the canvas pixels it covers, an integer offset
+        and a sub pixel shift, and pasted into the canvas in place, so
+        the cost of an image does not depend on the size of the
+        montage. Images are shifted on a pool of threads, as OpenCV
+        releases the GIL, and pasted in order so later images are on
+        top of earlier ones.
+    """
+
+    def __init__(self, workers=None, lookahead=None):
+        """
+            workers: threads shifting images, defaults to the number of cores
+            lookahead: images shifted ahead of the one being pasted
+        """
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.lookahead = 2 * self.workers if lookahead is None else lookahead
+
+    def tiles(self, positions, shapes, box, scales=None):
+        """
+            footprint of each image, skipping those off the canvas, as
+            (index, (top, left, rows, cols), start, scale)
+
+            scales: optional (x, y) factor from the pixels of each image
+                    to shape, None where they are already that size
+        """
+        scales = [None] * len(shapes) if scales is None else scales
+        tiles = []
+        for k, (position, shape) in enumerate(zip(positions, shapes)):
+            tile = footprint(position, shape, box)
+            if tile is not None:
+                tiles.append((k,) + tile + (scales[k],))
+        return tiles
+
+    def _shifted(self, pool, images, tiles):
+        """shift the image of each tile on the pool, yielding them in order"""
+        def shift(tile):
+            k, (top, left, rows, cols), start, scale = tile
+            return shift_image(images(k), start, (rows, cols), scale)
+        return utils.bounded_map(pool, shift, tiles, self.lookahead)
+
+    def render(self, images, tiles, box, canvas=None):
+        """
+            paste every tile into canvas, a new uint8 array of the size
+            of box if None
+
+            images: function from the index of an image to its pixels
+            tiles: from self.tiles
+        """
+        x_min, x_max, y_min, y_max = box
+        if canvas is None:
+            canvas = np.zeros([y_max - y_min, x_max - x_min], dtype=np.uint8)
+        for piece, (k, (top, left, rows, cols), start, scale) in self.pieces(images, tiles):
+            canvas[top:top + rows, left:left + cols] = piece
+        return canvas
+
+    def pieces(self, images, tiles):
+        """(shifted image, tile) of every tile, in order"""
+        if self.workers < 2:
+            for tile in tiles:
+                k, (top, left, rows, cols), start, scale = tile
+                yield shift_image(images(k), start, (rows, cols), scale), tile
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            yield from zip(self._shifted(pool, images, tiles), tiles)
@@ -0,0 +1,105 @@
+import numpy as np
+
+import os
+import threading
+import time
+import zipfile
+
+
+class Session:
+    """
+        On disk checkpoint of a TransformationFinder: every registration
+        computed so far, whether the search used it, and the tree of
+        matches as it was at the start of the last pass of the greedy
+        search. Images are identified by
+        the name of their confocal file, so a later run over the same
+        folder with movies added finds what it already knows.
+
+        Loading a session into a run over the same images resumes the
+        search where it stopped, and as registrations are deterministic
+        gives the montage an uninterrupted run would have. With movies
+        added, the saved montages are kept and only the new movies are
+        registered, to their neighbours. If any saved movie is gone the
+        saved registrations are reused but the montages are rebuilt.
+    """
+    VERSION = 2
+
+    def __init__(self, fname, interval=60.):
+        """
+            fname: .npz file the session is kept in
+            interval: seconds between checkpoints while registering
+        """
+        self.fname = fname
+        self.interval = interval
+        self._last_save = time.time()
+
+    def _names(self, tf):
+        return np.array([os.path.basename(mm.get_confocal_name()) for mm in tf.mmList])
+
+    def save(self, tf, matched):
+        """write the registrations of tf and the matches, replacing any earlier save"""
+        src, dst, inliers, translations = tf.registrations.edges()
+        used = tf.registrations.used_flags()
+        if matched is None:
+            matched = np.ones([len(tf.mmList), 1], dtype=np.int32) * tf.UNMATCHED
+
+        directory = os.path.dirname(os.path.abspath(self.fname))
+        os.makedirs(directory, exist_ok=True)
+        tmp_fname = '{}.{}.{}.tmp'.format(self.fname, os.getpid(), threading.get_ident())
+        with open(tmp_fname, 'wb') as f:
+            np.savez(
+                f,
+                version=Session.VERSION,
+                registration=tf.registration,
+                names=self._names(tf),
+                src=src,
+                dst=dst,
+                inliers=inliers,
+                translations=translations,
+                used=used,
+                matched=matched)
+        os.replace(tmp_fname, self.fname)
+        self._last_save = time.time()
+
+    def checkpoint(self, tf, matched):
+        """save if it has been interval seconds since the last save"""
+        if time.time() - self._last_save >= self.interval:
+            self.save(tf, matched)
+
+    def load(self, tf):
+        """
+            add the saved registrations of images tf still has to it and
+            return the saved matches in terms of tf.mmList, with new
+            images unmatched. Returns None and adds nothing if there is
+            no usable session
+        """
+        try:
+            with np.load(self.fname) as data:
+                saved = {key: data[key] for key in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        if int(saved['version']) != Session.VERSION:
+            print('Ignoring session {} from another version'.format(self.fname))
+            return None
+        if str(saved['registration']) != tf.registration:
+            print('Ignoring session {} registered with {}'.format(self.fname, saved['registration']))
+            return None
+
+        # where each saved image is now, -1 if gone
+        current = {name: k for k, name in enumerate(self._names(tf))}
+        index = np.array([current.get(name, -1) for name in saved['names']], dtype=np.int64)
+
+        src, dst = index[saved['src']], index[saved['dst']]
+        for k in np.flatnonzero((src >= 0) & (dst >= 0)):
+            tf.store_translation(int(src[k]), int(dst[k]), saved['inliers'][k], saved['translations'][k])
+            if saved['used'][k]:
+                tf.registrations.mark_used(int(src[k]), int(dst[k]))
+
+        matched = np.ones([len(tf.mmList), 1], dtype=np.int32) * tf.UNMATCHED
+        if np.any(index < 0):
+            print('Movies missing since {} was saved, rebuilding the montages'.format(self.fname))
+            return matched
+        saved_matched = saved['matched'].ravel()
+        done = saved_matched != tf.UNMATCHED
+        matched[index[done], 0] = index[saved_matched[done]]
+        return matched
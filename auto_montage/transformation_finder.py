@@ -1,18 +1,101 @@
 from . import multi_modal_image
 from . import features
+from . import feature_extractor
+from . import phase_correlation
+from . import registration_store
+from . import instrumentation
 from . import utils
 
 from scipy import ndimage
+from scipy import spatial
 import numpy as np
+import heapq
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
 
+def closest_within(positions, thresh):
+    """
+        for each position the indices of the others whose squared
+        distance is below thresh, sorted closest first (ties by index).
+        Uses a kd-tree so only nearby positions are ever compared
+
+        output:
+            dict[image_id] = sorted_list_of_images
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    closest_to = dict()
+    if positions.shape[0] == 0:
+        return closest_to
+
+    # the ball is a little larger than needed, the exact
+    # squared distances below decide who is close enough
+    tree = spatial.cKDTree(positions)
+    radius = math.sqrt(thresh) * (1. + 1e-6)
+    candidates = tree.query_ball_point(positions, radius)
+
+    for src in range(positions.shape[0]):
+        dsts = np.array(candidates[src], dtype=np.int64)
+        distance = positions[src] - positions[dsts]
+        distance = (distance*distance).sum(axis=1)
+
+        keep = (distance < thresh) & (dsts != src)
+        dsts = dsts[keep]
+        distance = distance[keep]
+
+        order = np.lexsort((dsts, distance))
+        closest_to[src] = dsts[order].tolist()
+    return closest_to
+
+
+class Frontier:
+    """
+        The unmatched images the greedy search still has to try, in
+        passes of increasing index. An image only needs trying again
+        once a neighbour has been matched since it was last tried,
+        otherwise it would be rejected again. One gaining a matched
+        neighbour ahead of where the pass is joins this pass, one
+        behind it waits for the next, as when every image was tried
+        on every pass
+    """
+
+    def __init__(self, n):
+        self.current = []
+        self.next = []
+        self.queued = np.zeros([n], dtype=bool)
+
+    def push(self, k, position):
+        """queue image k, found while the pass is at image position"""
+        if self.queued[k]:
+            return
+        self.queued[k] = True
+        heapq.heappush(self.current if k > position else self.next, k)
+
+    def pop(self,):
+        k = heapq.heappop(self.current)
+        self.queued[k] = False
+        return k
+
+    def ahead(self,):
+        """the images still to try in this pass, in order"""
+        return sorted(self.current)
+
+    def next_pass(self,):
+        """start the next pass, False if there is nothing to try"""
+        if not self.current:
+            self.current, self.next = self.next, []
+        return len(self.current) > 0
+
+
 class TransformationFinder:
 
     UNMATCHED = -1
     nom_thresh = 7.
     auto_accept = 50
+    # pairs registered per batch when running concurrently
+    batch_size = 64
     avg = 0.
     n = 0.
     """
@@ -20,19 +103,32 @@ class TransformationFinder:
         and descriptors. Then try to match these images, thus constructing
         pairwise registrations.
     """
-    def __init__(self, mmList):
+    REGISTRATIONS = ('orb', 'phase', 'orb+phase')
+
+    def __init__(self, mmList, registration='orb'):
+        """
+            registration: how pairs are registered
+                'orb' match ORB features and find the translation by ransac
+                'phase' FFT phase correlation, see PhaseCorrelation
+                'orb+phase' ORB, falling back to phase correlation for
+                            pairs with too few inliers
+        """
+        if registration not in TransformationFinder.REGISTRATIONS:
+            raise ValueError('No registration named {}'.format(registration))
         self.mmList = mmList
         self._num = len(mmList)
+        self.registration = registration
+        self.phase_correlation = None
+        if registration != 'orb':
+            max_shape = np.max([mm.get_shape() for mm in mmList], axis=0)
+            self.phase_correlation = phase_correlation.PhaseCorrelation(max_shape)
 
         # a dictionary of 
         # dict[image_id] = sorted_list_of_closest_images
         self.closest_mm_images = self.build_closest()
 
-        # space to store translations, numbers of matches and if we have
-        # already calculated some registration
-        self.translations = np.zeros([self._num,self._num,2])
-        self.inlier_matches = np.zeros([self._num,self._num], dtype=np.int16)
-        self.have_computed = np.zeros([self._num,self._num], dtype=np.bool)
+        # translations and numbers of matches of the pairs registered
+        self.registrations = registration_store.RegistrationStore()
         self.min_inliers = 10
         self.matched = None
     
@@ -44,51 +140,32 @@ class TransformationFinder:
             output:
                 dict[image_id] = sorted_list_of_images
         """
+        positions = [mm.get_nominal() for mm in self.mmList]
+        return closest_within(positions, TransformationFinder.nom_thresh)
 
-        closest_to = dict()
-
-        # for each image_id
-        for src in range(self._num):
-
-            # current image and its location
-            src_im = self.mmList[src]
-            src_pos = src_im.get_nominal()
-
-            # save all the close enough images here
-            dsts = []
-            for dst in range(self._num):
-
-                # ignore if same image
-                if dst == src:
-                    continue
-
-                # distance between src and dst
-                dst_im = self.mmList[dst]
-                dst_pos = dst_im.get_nominal()
-                distance = (src_pos - dst_pos)
-                distance = (distance*distance).sum()
-
-                # save if within threshold
-                if distance < TransformationFinder.nom_thresh:
-                    dsts.append((dst, distance))
-
-            # for current image sort the closest images 
-            # based on distance
-            dsts.sort(key=lambda x: x[1])
-            dsts = list(map(lambda x: x[0], dsts))
-            closest_to[src] = dsts
-        return closest_to
+    def compute_kps_desc(self, workers=None, backend='thread', previews=()):
+        """
+            compute keypoints and descriptors for every image and
+            modality on a pool of workers, see FeatureExtractor
+            previews: (modality, scale) of previews to make while the
+                      pixels are read
+        """
+        # phase correlation works on the pixels alone
+        if self.registration == 'phase':
+            return
+        extractor = feature_extractor.FeatureExtractor(workers, backend, previews=previews)
+        extractor.run(self.mmList)
 
-    def compute_kps_desc(self,):
-        for mm in self.mmList:
-            mm.calculate_orb()
-        
     def match_two_images(self, mm1, mm2):
-        """given two MMImages match the descriptors for each channel individually"""
-        matches = dict(split=[], confocal=[], avg=[])
+        """
+            given two MMImages match the descriptors for each channel
+            individually, giving (query_idx, train_idx) arrays per channel
+        """
+        matches = dict()
         for key in multi_modal_image.MultiModalImage.index.keys():
-            modality_matches, key = features.match_desc(mm1.descriptors[key], mm2.descriptors[key], key)
-            matches[key] += modality_matches
+            modality_matches, key = features.match_index(mm1.descriptors[key], mm2.get_matcher(key), key)
+            matches[key] = modality_matches
+            instrumentation.count('matches_' + key, len(modality_matches[0]))
         return matches
 
     def get_all_matches(self, i, j):
@@ -103,66 +180,193 @@ class TransformationFinder:
         srcpts = []
         dstpts = []
         for key in multi_modal_image.MultiModalImage.index.keys():
-            kp1 = mm1.keypoints[key]
-            kp2 = mm2.keypoints[key]
-            ms = matches[key]
-            src_pts = np.float32([ kp1[m.queryIdx].pt for m in ms ]).reshape(-1,2)
-            dst_pts = np.float32([ kp2[m.trainIdx].pt for m in ms ]).reshape(-1,2)
-            srcpts.append(src_pts)
-            dstpts.append(dst_pts)
+            query_idx, train_idx = matches[key]
+            srcpts.append(mm1.keypoints[key][query_idx])
+            dstpts.append(mm2.keypoints[key][train_idx])
 
         src_pts = np.concatenate(srcpts, axis=0)
         dst_pts = np.concatenate(dstpts, axis=0)
 
         return src_pts, dst_pts
 
-    def compute_translation(self, i, j):
+    def register_orb(self, i, j):
         src, dst = self.get_all_matches(i, j)
-        inliers, translation = features.ransac(src, dst)
-
-        self.translations[i,j,:] = translation
-        self.inlier_matches[i,j] = inliers
-        self.have_computed[i,j] = True
-
-    def get_translation(self, i, j):
-        return self.translations[i,j,:]
-
-    def get_inliers(self, i, j):
-        return self.inlier_matches[i,j]
 
-    def compute_pairwise_registrations(self, q, i, fov):
-        matched = np.ones([self._num, 1], dtype=np.int32)*TransformationFinder.UNMATCHED
+        # seeded per pair so the result does not depend on
+        # which pairs were registered before, or in what order
+        rng = np.random.RandomState(i * self._num + j)
+        return features.ransac(src, dst, rng=rng)
 
-        # while anything is still unmatched
-        total_matched = 0
-        while np.any(matched==TransformationFinder.UNMATCHED):
-        
-            # first unmatched image
-            # match to self, ie new global ref
-            id_unmatched = np.argmin(matched)
-            matched[id_unmatched] = id_unmatched
+    def register(self, i, j):
+        """
+            find the translation from image i to image j and its number
+            of inliers, without storing it. Safe to call from several
+            threads at once
+        """
+        instrumentation.count('pairs_attempted')
+        if self.registration == 'phase':
+            return self.phase_correlation.register(self.mmList[i], self.mmList[j])
+
+        inliers, translation = self.register_orb(i, j)
+        if self.registration == 'orb+phase' and inliers <= self.min_inliers:
+            # in ORB inliers, see PhaseCorrelation.inlier_equivalent
+            phase_inliers, phase_translation = self.phase_correlation.register(
+                self.mmList[i], self.mmList[j])
+            if phase_inliers > inliers:
+                return phase_inliers, phase_translation
+        return inliers, translation
+
+    def store_translation(self, i, j, inliers, translation):
+        self.registrations.add(i, j, inliers, translation)
 
-            # if add new ref check again
-            new_ref = True
+    def compute_translation(self, i, j):
+        inliers, translation = self.register(i, j)
+        self.store_translation(i, j, inliers, translation)
 
-            while new_ref:
+    def _register_pair(self, pair):
+        return self.register(*pair)
 
-                # make sure something is added
-                new_ref = False
+    def _next_pair(self, matched, src_mm, current):
+        """
+            the next registration the greedy search will ask for when it
+            reaches src_mm, or None if it has all it needs. Also returns
+            whether this is certain: it is not if a neighbour closer
+            than the pair may still be matched, in this pass, before
+            src_mm is reached
+        """
+        certain = True
+        for dst_mm in self.closest_mm_images[src_mm]:
+            if matched[dst_mm] == TransformationFinder.UNMATCHED:
+                if current <= dst_mm < src_mm:
+                    certain = False
+                continue
+            if not self.registrations.computed(src_mm, dst_mm):
+                return (src_mm, dst_mm), certain
+            if self.get_inliers(src_mm, dst_mm) >= TransformationFinder.auto_accept:
+                return None, certain
+        return None, certain
+
+    def speculate(self, matched, current, pool, workers, candidates=None):
+        """
+            register concurrently the pairs the greedy search is about
+            to ask for, looking ahead from image current. Takes up to
+            batch_size pairs which are certain to be needed, and if that
+            does not fill the pool guesses at some which may be needed
+            candidates: the images from current on the search will try,
+                        in order, all of them by default
+        """
+        certain = []
+        guesses = []
+        candidates = range(current, self._num) if candidates is None else candidates
+        for src_mm in candidates:
+            if len(certain) >= TransformationFinder.batch_size:
+                break
+            if matched[src_mm] != TransformationFinder.UNMATCHED:
+                continue
+            pair, is_certain = self._next_pair(matched, src_mm, current)
+            if pair is None:
+                continue
+            if is_certain:
+                certain.append(pair)
+            elif len(guesses) < workers:
+                guesses.append(pair)
+
+        pairs = certain + guesses[:max(0, workers - len(certain))]
+        results = pool.map(self._register_pair, pairs)
+        for (src_mm, dst_mm), (inliers, translation) in zip(pairs, results):
+            self.store_translation(src_mm, dst_mm, inliers, translation)
 
-                # search through images we will move
-                for src_mm in range(self._num):
+    def get_translation(self, i, j):
+        return self.registrations.get_translation(i, j)
 
-                    # print progress
-                    num_matched = np.sum(matched!=TransformationFinder.UNMATCHED)
-                    if num_matched > total_matched:
-                        total_matched = num_matched
-                        q.put((num_matched, self._num, i, fov))
-                        #utils.printProgressBar(total_matched, self._num)
+    def get_inliers(self, i, j):
+        return self.registrations.get_inliers(i, j)
 
-                    # if this is already matched skip
-                    if matched[src_mm] != TransformationFinder.UNMATCHED:
-                        continue
+    def compute_pairwise_registrations(self, q, i, fov, workers=None, session=None):
+        """
+            greedily grow montages, matching each unmatched image to the
+            already matched neighbour with the most inliers.
+
+            workers: with more than one worker the registrations an image
+                     may need are computed ahead of time, in batches, on
+                     a thread pool. The accept/reject decisions are made
+                     in the same order as the serial search, so the
+                     montage is identical
+            session: optional Session. What it holds is loaded first, so
+                     an interrupted run resumes and a run with new movies
+                     only registers those. It is saved as the search goes
+                     and once done
+        """
+        matched = None
+        if session is not None:
+            matched = session.load(self)
+
+        workers = workers if workers is not None else (os.cpu_count() or 1)
+        pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            self._greedy_registration(q, i, fov, pool, workers, matched, session)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if session is not None:
+            session.save(self, self.matched)
+
+    def _set_matched(self, matched, waiting, src_mm, dst_mm):
+        """
+            record src_mm as matched to dst_mm. An image is only ever a
+            destination for its unmatched neighbours, so once none are
+            left its matcher index is freed
+        """
+        matched[src_mm] = dst_mm
+        for neighbour in self.closest_mm_images[src_mm] + [src_mm]:
+            if neighbour != src_mm:
+                waiting[neighbour] -= 1
+            if waiting[neighbour] == 0 and matched[neighbour] != TransformationFinder.UNMATCHED:
+                self._release(self.mmList[neighbour])
+
+    def _release(self, mm):
+        """free what is only kept to register other images to mm"""
+        mm.release_matchers()
+        if self.phase_correlation is not None:
+            self.phase_correlation.release(mm)
+
+    def _queue_neighbours(self, frontier, matched, mm, position):
+        """queue the unmatched neighbours of mm, just matched with the pass at position"""
+        for neighbour in self.closest_mm_images[mm]:
+            if matched[neighbour] == TransformationFinder.UNMATCHED:
+                frontier.push(neighbour, position)
+
+    def _greedy_registration(self, q, i, fov, pool, workers, matched=None, session=None):
+        if matched is None:
+            matched = np.ones([self._num, 1], dtype=np.int32)*TransformationFinder.UNMATCHED
+
+        # number of unmatched neighbours of each image
+        unmatched = matched.ravel() == TransformationFinder.UNMATCHED
+        waiting = [int(np.sum(unmatched[self.closest_mm_images[x]])) for x in range(self._num)]
+
+        # to start, every unmatched image next to a matched one
+        frontier = Frontier(self._num)
+        for src_mm in np.flatnonzero(unmatched):
+            if not np.all(unmatched[self.closest_mm_images[src_mm]]):
+                frontier.push(src_mm, -1)
+        num_matched = int(self._num - np.sum(unmatched))
+        if num_matched > 0:
+            q.put((num_matched, self._num, i, fov))
+        first_unmatched = 0
+
+        # grow the montages from what is already matched, then
+        # while anything is still unmatched start a new one
+        while True:
+
+            # a pass through the images which may now match
+            while frontier.next_pass():
+
+                # where a resumed search starts from
+                pass_start = matched.copy() if session is not None else None
+
+                while frontier.current:
+                    src_mm = frontier.pop()
 
                     most_inliers = 0
                     best_dst_id = -1
@@ -175,18 +379,47 @@ class TransformationFinder:
                             continue
                         
                         # if we havent calculated everything already
-                        if not self.have_computed[src_mm, dst_mm]:
-                            self.compute_translation(src_mm, dst_mm)
+                        if not self.registrations.computed(src_mm, dst_mm):
+                            if pool is None:
+                                self.compute_translation(src_mm, dst_mm)
+                            else:
+                                candidates = [src_mm] + frontier.ahead()
+                                self.speculate(matched, src_mm, pool, workers, candidates)
+                            if session is not None:
+                                session.checkpoint(self, pass_start)
 
                         # if better than all previous
-                        if self.inlier_matches[src_mm, dst_mm] >= most_inliers:
-                            most_inliers = self.inlier_matches[src_mm, dst_mm]
+                        inliers = self.get_inliers(src_mm, dst_mm)
+                        self.registrations.mark_used(src_mm, dst_mm)
+                        if inliers >= most_inliers:
+                            most_inliers = inliers
                             best_dst_id = dst_mm
 
                             if most_inliers >= TransformationFinder.auto_accept:
                                 break
 
                     if most_inliers > self.min_inliers:
-                        matched[src_mm] = best_dst_id
-                        new_ref = True
+                        self._set_matched(matched, waiting, src_mm, best_dst_id)
+                        self._queue_neighbours(frontier, matched, src_mm, src_mm)
+                        instrumentation.count('pairs_accepted')
+                        num_matched += 1
+                        q.put((num_matched, self._num, i, fov))
+
+            if num_matched == self._num:
+                break
+
+            # first unmatched image
+            # match to self, ie new global ref
+            while matched[first_unmatched] != TransformationFinder.UNMATCHED:
+                first_unmatched += 1
+            self._set_matched(matched, waiting, first_unmatched, first_unmatched)
+
+            # then a new pass, from the start
+            self._queue_neighbours(frontier, matched, first_unmatched, -1)
+            instrumentation.count('montages_started')
+            num_matched += 1
+            q.put((num_matched, self._num, i, fov))
+
+        for mm in self.mmList:
+            self._release(mm)
         self.matched = matched
\ No newline at end of file
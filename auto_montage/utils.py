@@ -2,21 +2,103 @@ from PIL import Image
 import numpy as np
 import cv2
 
+from concurrent.futures import ThreadPoolExecutor
+import collections
+
+
+# uncompressed pixel layouts which can be read straight from the file
+RAW_CHANNELS = {'L': 1, 'LA': 2, 'RGB': 3, 'RGBA': 4}
+
+
+def _read_raw(fname, im):
+    """
+        if the image is one uncompressed block of 8 bit pixels read it
+        directly into a numpy array, otherwise return None
+    """
+    if len(im.tile) != 1:
+        return None
+    codec, extents, offset, args = im.tile[0][:4]
+    w, h = im.size
+    if codec != 'raw' or tuple(extents) != (0, 0, w, h):
+        return None
+    if not isinstance(args, tuple) or len(args) != 3:
+        return None
+    rawmode, stride, orientation = args
+    channels = RAW_CHANNELS.get(rawmode)
+    if channels is None or rawmode != im.mode or orientation != 1:
+        return None
+    if stride not in (0, w * channels):
+        return None
+
+    buffer = np.empty([h, w, channels], dtype=np.uint8)
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        if f.readinto(memoryview(buffer).cast('B')) != buffer.nbytes:
+            return None
+    if channels == 1:
+        return buffer.reshape(h, w)
+    return np.ascontiguousarray(buffer[:, :, 0])
+
 
 def load_from_fname(fname, resize):
     """
         loads image and gets rid of any extra unused dimensions
         as they smeetimes save as rgb accidently
     """
-    im = Image.open(fname)
-    if len(im.split()) > 1:
-        im = im.split()[0]
-    im = np.array(im.getdata(), dtype = np.uint8).reshape(im.size[1], im.size[0])
+    with Image.open(fname) as im:
+        image = _read_raw(fname, im)
+        if image is None:
+            # compressed or unusual layout, let PIL decode it
+            if len(im.getbands()) > 1:
+                im = im.getchannel(0)
+            image = np.asarray(im)
+            if image.dtype != np.uint8:
+                image = image.astype(np.uint8)
+
+    if resize is not None:
+        h, w = scaled_shape(image.shape, resize)
+        image = cv2.resize(image, (w, h))
+    return image
+
+
+def scaled_shape(shape, resize):
+    """(height, width) of an image of shape once resized"""
+    h, w = shape[:2]
     if resize is not None:
-        h = int(im.shape[0] * resize)
-        w = int(im.shape[1] * resize)
-        im = cv2.resize(im, (w, h))
-    return im
+        h = int(h * resize)
+        w = int(w * resize)
+    return h, w
+
+
+def shape_from_fname(fname, resize):
+    """(height, width) load_from_fname would return, only reads the header"""
+    with Image.open(fname) as im:
+        w, h = im.size
+    return scaled_shape((h, w), resize)
+
+
+def bounded_map(pool, fn, items, lookahead):
+    """
+        fn of each item, run on pool and yielded in order, as pool.map
+        but submitting at most lookahead items ahead of the consumer
+    """
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= lookahead:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def load_many(fnames, resize, workers=4, lookahead=None):
+    """
+        load a list of images on background threads, yielding them in
+        order. At most lookahead images are loaded ahead of the consumer
+    """
+    lookahead = 2 * workers if lookahead is None else lookahead
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from bounded_map(pool, lambda fname: load_from_fname(fname, resize), fnames, lookahead)
 
 # Print iterations progress
 def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '*'):
@@ -0,0 +1,67 @@
+"""
+    Time finding the images within nom_thresh of each image, with the
+    kd-tree of transformation_finder.closest_within against the old
+    comparison of every image with every other, for growing sessions.
+
+    python -m benchmarks.bench_build_closest --movies 100 1000 10000
+"""
+from auto_montage import transformation_finder
+
+from . import synthetic
+
+import numpy as np
+
+import argparse
+from time import time
+
+
+def all_pairs_closest(positions, thresh):
+    """the nested loop build_closest used to run"""
+    closest_to = dict()
+    for src in range(len(positions)):
+        dsts = []
+        for dst in range(len(positions)):
+            if dst == src:
+                continue
+            distance = (positions[src] - positions[dst])
+            distance = (distance*distance).sum()
+            if distance < thresh:
+                dsts.append((dst, distance))
+        dsts.sort(key=lambda x: x[1])
+        closest_to[src] = list(map(lambda x: x[0], dsts))
+    return closest_to
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--movies', type=int, nargs='+', default=[100, 300, 1000, 3000])
+    parser.add_argument('--step', type=float, default=0.6,
+                        help='spacing of the nominal positions in degrees')
+    parser.add_argument('--max-all-pairs', type=int, default=3000,
+                        help='skip the old method above this many movies')
+    args = parser.parse_args()
+
+    thresh = transformation_finder.TransformationFinder.nom_thresh
+    rng = np.random.RandomState(0)
+    print('{:>8} {:>12} {:>12} {:>8}'.format('movies', 'all pairs', 'kd-tree', 'speedup'))
+    for n in args.movies:
+        positions = list(synthetic.grid_positions(n, args.step, rng))
+
+        start = time()
+        closest = transformation_finder.closest_within(positions, thresh)
+        tree_time = time() - start
+
+        if n > args.max_all_pairs:
+            print('{:>8} {:>12} {:>11.3f}s {:>8}'.format(n, '-', tree_time, '-'))
+            continue
+
+        start = time()
+        reference = all_pairs_closest(positions, thresh)
+        pairs_time = time() - start
+        assert closest == reference, 'kd-tree neighbours differ'
+        print('{:>8} {:>11.3f}s {:>11.3f}s {:>7.1f}x'.format(
+            n, pairs_time, tree_time, pairs_time / tree_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+    Time matching every image to its neighbours, rebuilding the LSH
+    index for each pair as match_desc does, against querying the index
+    each image keeps for its lifetime as a destination.
+
+    python -m benchmarks.bench_matching --movies 100
+"""
+from auto_montage import features
+from auto_montage import multi_modal_image
+from auto_montage import transformation_finder
+
+from . import synthetic
+
+import argparse
+import tempfile
+from time import time
+
+
+def neighbour_pairs(tf, max_neighbours):
+    return [
+        (src, dst)
+        for src in range(tf._num)
+        for dst in tf.closest_mm_images[src][:max_neighbours]
+    ]
+
+
+def time_rebuild(mm_list, pairs):
+    start = time()
+    for src, dst in pairs:
+        for modality in multi_modal_image.MultiModalImage.index.keys():
+            features.match_desc(
+                mm_list[src].descriptors[modality],
+                mm_list[dst].descriptors[modality],
+                modality)
+    return time() - start
+
+
+def time_reuse(mm_list, pairs):
+    start = time()
+    for src, dst in pairs:
+        for modality in multi_modal_image.MultiModalImage.index.keys():
+            features.match_index(
+                mm_list[src].descriptors[modality],
+                mm_list[dst].get_matcher(modality),
+                modality)
+    for mm in mm_list:
+        mm.release_matchers()
+    return time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--movies', type=int, default=64)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--neighbours', type=int, default=8,
+                        help='number of closest images each image is matched to')
+    args = parser.parse_args()
+
+    multi_modal_image.MultiModalImage.feature_cache = None
+    with tempfile.TemporaryDirectory() as directory:
+        movies = synthetic.write_session(directory, args.movies, size=args.size)
+        mm_list = synthetic.as_multi_modal_objects(movies)
+
+    tf = transformation_finder.TransformationFinder(mm_list)
+    tf.compute_kps_desc()
+    pairs = neighbour_pairs(tf, args.neighbours)
+
+    rebuild = time_rebuild(mm_list, pairs)
+    reuse = time_reuse(mm_list, pairs)
+    print('{} movies, {} pairs, 3 modalities each'.format(args.movies, len(pairs)))
+    print('index per pair:  {:.2f}s'.format(rebuild))
+    print('index per image: {:.2f}s'.format(reuse))
+    print('speedup: {:.2f}x'.format(rebuild / reuse))
+
+
+if __name__ == '__main__':
+    main()
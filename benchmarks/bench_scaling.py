@@ -0,0 +1,165 @@
+"""
+    Run the whole of auto_montage.main, headless, on synthetic sessions
+    of growing size, each in a fresh process. Records the wall time,
+    peak memory and time of each stage, from the trace of
+    auto_montage.instrumentation, and fits the exponent k of
+    time ~ movies^k for each, overall and between consecutive sizes.
+
+    python -m benchmarks.bench_scaling --movies 50 100 200 500 1000 --out scaling.json
+
+    Sessions are written to a temporary directory and removed after
+    each size, 10000 movies of 256px need about 2GB of disk. Once a
+    size fails or takes longer than --timeout larger ones are skipped.
+"""
+from . import synthetic
+from .bench_stages import environment
+
+import numpy as np
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+
+def run_child(directory, workers):
+    """
+        montage the session in directory, returning the wall time, peak
+        memory, and the time, peak memory and counters of each stage
+    """
+    from auto_montage import auto_montage
+    from auto_montage import multi_modal_image
+
+    multi_modal_image.MultiModalImage.feature_cache = None
+    output = os.path.join(directory, 'output')
+    trace = os.path.join(directory, 'trace.json')
+    os.makedirs(output)
+    start = perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        auto_montage.main(
+            directory, os.path.join(directory, 'nominal.xlsx'), 'OD', synthetic.NAMING,
+            output, workers=workers, trace=trace)
+    wall = perf_counter() - start
+
+    with open(trace) as f:
+        trace = json.load(f)
+    return {
+        'wall': wall,
+        'peak_rss': trace['peak_rss'],
+        'stages': {name: total['seconds'] for name, total in trace['totals'].items()},
+        'stage_peak_rss': {name: total['peak_rss'] for name, total in trace['totals'].items()},
+        'counters': trace['counters'],
+    }
+
+
+def run_size(movies, args):
+    """write a session of movies and montage it in a new process"""
+    with tempfile.TemporaryDirectory(dir=args.temp) as directory:
+        session = synthetic.write_session(directory, movies, size=args.size, seed=args.seed)
+        synthetic.write_nominal_xlsx(os.path.join(directory, 'nominal.xlsx'), session)
+        del session
+
+        command = [sys.executable, '-m', 'benchmarks.bench_scaling', '--child', directory]
+        if args.workers is not None:
+            command += ['--workers', str(args.workers)]
+        try:
+            child = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            return {'movies': movies, 'status': 'timeout'}
+    if child.returncode != 0:
+        return {'movies': movies, 'status': 'failed', 'error': child.stderr.strip().splitlines()[-1:]}
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    result.update({'movies': movies, 'status': 'ok'})
+    return result
+
+
+def exponent(movies, values):
+    """k of the least squares fit of log(values) = k log(movies) + c"""
+    movies, values = np.asarray(movies, dtype=np.float64), np.asarray(values, dtype=np.float64)
+    keep = values > 0
+    if keep.sum() < 2:
+        return None
+    return float(np.polyfit(np.log(movies[keep]), np.log(values[keep]), 1)[0])
+
+
+def fit(runs):
+    """exponent of the wall time, peak memory and each stage, overall and per step"""
+    ok = [run for run in runs if run['status'] == 'ok']
+    movies = [run['movies'] for run in ok]
+    series = {'wall': [run['wall'] for run in ok], 'peak_rss': [run['peak_rss'] for run in ok]}
+    stages = dict.fromkeys(stage for run in ok for stage in run['stages'])
+    for stage in stages:
+        series[stage] = [run['stages'].get(stage, 0.) for run in ok]
+
+    exponents = dict()
+    for name, values in series.items():
+        steps = [exponent(movies[k:k + 2], values[k:k + 2]) for k in range(len(ok) - 1)]
+        exponents[name] = {'overall': exponent(movies, values), 'steps': steps}
+    return exponents
+
+
+def print_run(run):
+    if run['status'] != 'ok':
+        print('{:>7} {}'.format(run['movies'], run['status']))
+        return
+    shares = ', '.join(
+        '{} {:.0%}'.format(stage, seconds / run['wall'])
+        for stage, seconds in sorted(run['stages'].items(), key=lambda x: -x[1]))
+    print('{:>7} {:>9.1f}s {:>8.0f}MB  {}'.format(run['movies'], run['wall'], run['peak_rss'] / 1024 ** 2, shares))
+
+
+def print_exponents(exponents):
+    print('{:<32} {:>8}  {}'.format('', 'exponent', 'between sizes'))
+    for name, values in exponents.items():
+        if values['overall'] is None:
+            continue
+        steps = ' '.join('-' if step is None else '{:.2f}'.format(step) for step in values['steps'])
+        print('{:<32} {:>8.2f}  {}'.format(name, values['overall'], steps))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--movies', type=int, nargs='+', default=[50, 100, 200, 500, 1000, 2000, 5000, 10000])
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=3600.,
+                        help='seconds a size may take before larger ones are skipped')
+    parser.add_argument('--temp', default=None, help='directory sessions are written to')
+    parser.add_argument('--out', default=None, help='json file the results are written to')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_child(args.child, args.workers)))
+        return
+
+    print('{:>7} {:>10} {:>10}  {}'.format('movies', 'wall', 'peak', 'share of wall time'))
+    runs = []
+    for movies in sorted(args.movies):
+        runs.append(run_size(movies, args))
+        print_run(runs[-1])
+        if runs[-1]['status'] != 'ok':
+            break
+    exponents = fit(runs)
+    print_exponents(exponents)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'benchmark': 'scaling',
+                'config': vars(args),
+                'environment': environment(),
+                'runs': runs,
+                'exponents': exponents,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
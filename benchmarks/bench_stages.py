@@ -0,0 +1,247 @@
+"""
+    Time each stage of montaging a synthetic session separately, and
+    check the montage against the true offsets of the tiles. Results
+    are written as JSON, which a later run can be compared to.
+
+    python -m benchmarks.bench_stages --movies 64 --out stages.json
+    python -m benchmarks.bench_stages --movies 64 --compare stages.json
+"""
+from auto_montage import auto_montage
+from auto_montage import features
+from auto_montage import input_pipeline
+from auto_montage import montage_builder
+from auto_montage import multi_modal_image
+from auto_montage import script_maker
+from auto_montage import transformation_finder
+from auto_montage import utils
+
+from . import synthetic
+
+import numpy as np
+import cv2
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+from time import perf_counter
+
+
+def environment():
+    """what the timings depend on besides the code"""
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'opencv_threads': cv2.getNumThreads(),
+    }
+
+
+def time_stage(stage, repeat):
+    """
+        run stage, a function returning how many calls it timed, repeat
+        times. Returns the seconds of each run and the calls per run
+    """
+    runs = []
+    calls = 0
+    for _ in range(repeat):
+        start = perf_counter()
+        calls = stage()
+        runs.append(perf_counter() - start)
+    return {
+        'calls': calls,
+        'runs': runs,
+        'best': min(runs),
+        'median': float(np.median(runs)),
+        'per_call': min(runs) / max(calls, 1),
+    }
+
+
+def neighbour_pairs(tf, max_neighbours):
+    return [
+        (src, dst)
+        for src in range(tf._num)
+        for dst in tf.closest_mm_images[src][:max_neighbours]
+    ]
+
+
+def montage_error(mb, movies):
+    """
+        largest distance in pixels of a tile from its true place, over
+        the biggest montage, and the number of montages
+    """
+    # both (x, y), up to where the montage starts
+    truth = np.array([movie['offset'] for movie in movies], dtype=np.float64)
+    labels = mb.labels
+    biggest = np.argmax(np.bincount(labels))
+    members = labels == biggest
+    error = mb.positions[members] - truth[members]
+    error -= np.median(error, axis=0)
+    return {
+        'montages': int(labels.max() + 1),
+        'largest_montage': int(members.sum()),
+        'max_error': float(np.sqrt((error ** 2).sum(axis=1)).max()),
+    }
+
+
+def run(args, directory):
+    movies = synthetic.write_session(directory, args.movies, size=args.size, seed=args.seed)
+    nominal = os.path.join(directory, 'nominal.xlsx')
+    synthetic.write_nominal_xlsx(nominal, movies)
+    fnames = [movie[modality] for movie in movies for modality in ('confocal', 'split', 'avg')]
+
+    def load():
+        for fname in fnames:
+            utils.load_from_fname(fname, None)
+        return len(fnames)
+
+    stages = dict()
+    stages['load_from_fname'] = time_stage(load, args.repeat)
+
+    # the montage is built from what the pipeline reads, as in main
+    pipeline = input_pipeline.InputPipeline(directory, nominal, synthetic.NAMING, 'OD')
+    mm_list = pipeline.as_multi_modal_objects()[args.fov]
+    order = [int(os.path.basename(mm.get_confocal_name()).split('_')[2]) for mm in mm_list]
+    movies = [movies[k] for k in order]
+    images = [(mm.get_modality(modality), modality) for mm in mm_list
+              for modality in multi_modal_image.MultiModalImage.index.keys()]
+
+    def compute_kps_desc():
+        for image, modality in images:
+            features.compute_kps_desc(image)
+        return len(images)
+
+    stages['compute_kps_desc'] = time_stage(compute_kps_desc, args.repeat)
+
+    tf = transformation_finder.TransformationFinder(mm_list, args.registration)
+    tf.compute_kps_desc(args.workers)
+
+    def build_closest():
+        tf.build_closest()
+        return 1
+
+    stages['build_closest'] = time_stage(build_closest, args.repeat)
+
+    pairs = neighbour_pairs(tf, args.neighbours)
+    modalities = list(multi_modal_image.MultiModalImage.index.keys())
+
+    def match_desc():
+        for src, dst in pairs:
+            for modality in modalities:
+                features.match_desc(
+                    mm_list[src].descriptors[modality],
+                    mm_list[dst].descriptors[modality],
+                    modality)
+        return len(pairs) * len(modalities)
+
+    stages['match_desc'] = time_stage(match_desc, args.repeat)
+
+    points = [tf.get_all_matches(src, dst) for src, dst in pairs]
+    for mm in mm_list:
+        mm.release_matchers()
+
+    def ransac():
+        for k, (src, dst) in enumerate(points):
+            features.ransac(src, dst, rng=np.random.RandomState(k))
+        return len(points)
+
+    stages['ransac'] = time_stage(ransac, args.repeat)
+
+    # a new finder each run, as registrations are kept
+    registered = []
+
+    def compute_pairwise_registrations():
+        finder = transformation_finder.TransformationFinder(mm_list, args.registration)
+        finder.compute_pairwise_registrations(auto_montage.NoProgress(), 0, args.fov, args.workers)
+        registered.append(finder)
+        return finder.registrations.n
+
+    stages['compute_pairwise_registrations'] = time_stage(compute_pairwise_registrations, args.repeat)
+    tf = registered[-1]
+
+    built = []
+
+    def construct_all_montages():
+        mb = montage_builder.MontageBuilder(tf, evaluate=False, solver=args.solver)
+        built.append((mb, mb.construct_all_montages()))
+        return 1
+
+    stages['construct_all_montages'] = time_stage(construct_all_montages, args.repeat)
+    mb, disjoint_montages = built[-1]
+
+    transformations = [x[0] for x in disjoint_montages]
+
+    def write_photoshop_script():
+        script_maker.write_photoshop_script(transformations, directory, name='benchmark')
+        return 1
+
+    stages['write_photoshop_script'] = time_stage(write_photoshop_script, args.repeat)
+
+    return {
+        'benchmark': 'stages',
+        'config': vars(args),
+        'environment': environment(),
+        'pairs': len(pairs),
+        'registrations': int(tf.registrations.n),
+        'accuracy': montage_error(mb, movies),
+        'stages': stages,
+    }
+
+
+def print_results(results, baseline=None):
+    accuracy = results['accuracy']
+    print('{} movies, {} montages, largest {} movies off by at most {:.2f}px'.format(
+        results['config']['movies'], accuracy['montages'],
+        accuracy['largest_montage'], accuracy['max_error']))
+    header = '{:<32} {:>7} {:>11} {:>11}'.format('stage', 'calls', 'best', 'per call')
+    if baseline is not None:
+        header += ' {:>11} {:>8}'.format('baseline', 'ratio')
+    print(header)
+    for name, stage in results['stages'].items():
+        line = '{:<32} {:>7} {:>10.4f}s {:>10.6f}s'.format(
+            name, stage['calls'], stage['best'], stage['per_call'])
+        if baseline is not None and name in baseline['stages']:
+            before = baseline['stages'][name]['best']
+            line += ' {:>10.4f}s {:>7.2f}x'.format(before, before / stage['best'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--movies', type=int, default=64)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--fov', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each stage, the best is reported')
+    parser.add_argument('--neighbours', type=int, default=4,
+                        help='closest images each image is matched to for match_desc and ransac')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--registration', default='orb', choices=transformation_finder.TransformationFinder.REGISTRATIONS)
+    parser.add_argument('--solver', default='chain', choices=('chain', 'lsq'))
+    parser.add_argument('--out', default=None, help='json file the results are written to')
+    parser.add_argument('--compare', default=None, help='json file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    # features are computed every time, not read from the cache
+    multi_modal_image.MultiModalImage.feature_cache = None
+    with tempfile.TemporaryDirectory() as directory:
+        results = run(args, directory)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
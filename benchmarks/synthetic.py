@@ -0,0 +1,143 @@
+"""
+    Synthetic AOSLO sessions: a random cone mosaic cut into overlapping
+    tiles, saved as confocal/split/avg tif triples with known offsets.
+"""
+from PIL import Image
+import numpy as np
+import cv2
+
+import os
+import zipfile
+from xml.sax.saxutils import escape
+
+
+NAMING = {'confocal': 'confocal', 'split': 'split_det', 'avg': 'avg'}
+
+
+def cone_mosaic(h, w, rng, spacing=6.):
+    """blurred points on a jittered grid, roughly like a cone mosaic"""
+    ys, xs = np.mgrid[0:h:spacing, 0:w:spacing]
+    ys = ys.ravel() + rng.normal(0, spacing / 4., ys.size)
+    xs = xs.ravel() + rng.normal(0, spacing / 4., xs.size)
+    keep = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+
+    mosaic = np.zeros([h, w], dtype=np.float32)
+    mosaic[ys[keep].astype(int), xs[keep].astype(int)] = rng.uniform(0.3, 1., keep.sum())
+    mosaic = cv2.GaussianBlur(mosaic, (0, 0), spacing / 4.)
+    return mosaic * (255. / mosaic.max())
+
+
+def grid_positions(n, step, rng, jitter=0.1):
+    """nominal positions in degrees of n movies on a roughly square grid"""
+    cols = int(np.ceil(np.sqrt(n)))
+    rows = np.arange(n) // cols
+    columns = np.arange(n) % cols
+    positions = np.stack([-rows * step, columns * step], axis=1).astype(np.float64)
+    return positions + rng.uniform(-jitter, jitter, positions.shape) * step
+
+
+def write_session(directory, n, size=256, fov=1., step=0.6, seed=0, noise=5.):
+    """
+        write n tif triples to directory. Returns a list of dicts with
+        the file names, the nominal position in degrees, the fov and the
+        true (x, y) pixel offset of each tile in the mosaic
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    pixels_per_degree = size / fov
+
+    # true positions are the nominal ones plus some error
+    nominal = grid_positions(n, step, rng)
+    true = nominal + rng.normal(0, 0.03, nominal.shape)
+    offsets = np.stack([true[:, 1], -true[:, 0]], axis=1) * pixels_per_degree
+    offsets = np.round(offsets - offsets.min(axis=0)).astype(int) + 1
+
+    h, w = offsets[:, 1].max() + size + 2, offsets[:, 0].max() + size + 2
+    mosaic = cone_mosaic(h, w, rng)
+
+    movies = []
+    for movie, (x, y) in enumerate(offsets):
+        tile = mosaic[y:y + size, x:x + size]
+        movie_dict = {'nominal': nominal[movie], 'fov': fov, 'offset': (x, y), 'movie': movie}
+        for modality, gain in [('confocal', 1.), ('split', 0.6), ('avg', 0.8)]:
+            image = tile * gain + rng.normal(0, noise, tile.shape)
+            image = np.uint8(np.clip(image, 0, 255))
+            fname = os.path.join(
+                directory, 'synthetic_{}_{:04d}_ref.tif'.format(NAMING[modality], movie))
+            Image.fromarray(image).save(fname)
+            movie_dict[modality] = fname
+        movies.append(movie_dict)
+    return movies
+
+
+# the parts of an xlsx workbook with a single sheet, enough for xlrd
+XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+
+def _cell(column, row, value):
+    ref = '{}{}'.format('ABC'[column], row)
+    if isinstance(value, str):
+        return '<c r="{}" t="inlineStr"><is><t>{}</t></is></c>'.format(ref, escape(value))
+    return '<c r="{}"><v>{}</v></c>'.format(ref, value)
+
+
+def nominal_text(nominal):
+    """a nominal position in degrees as written in the xlsx, e.g. 0.6s1.2t"""
+    return '{:.4f}s{:.4f}t'.format(nominal[0], nominal[1])
+
+
+def write_nominal_xlsx(fname, movies):
+    """
+        write the movie number, nominal position and fov of each movie
+        as the first three columns of an xlsx, as InputPipeline reads
+        them. The positions are for the right eye, OD
+    """
+    rows = []
+    for row, movie in enumerate(movies, 1):
+        values = [movie['movie'], nominal_text(movie['nominal']), movie['fov']]
+        cells = ''.join(_cell(column, row, value) for column, value in enumerate(values))
+        rows.append('<row r="{}">{}</row>'.format(row, cells))
+    sheet = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<sheetData>{}</sheetData></worksheet>'.format(''.join(rows)))
+
+    with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as xlsx:
+        for name, part in XLSX_PARTS.items():
+            xlsx.writestr(name, part)
+        xlsx.writestr('xl/worksheets/sheet1.xml', sheet)
+
+
+def as_multi_modal_objects(movies):
+    from auto_montage import multi_modal_image
+    return [
+        multi_modal_image.MultiModalImage(
+            movie['confocal'], movie['split'], movie['avg'],
+            movie['nominal'], movie['fov'], None)
+        for movie in movies
+    ]